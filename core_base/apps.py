@@ -2,4 +2,11 @@ from django.apps import AppConfig
 
 class CoreBaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'core_base'
\ No newline at end of file
+    name = 'core_base'
+
+    def ready(self):
+        # 注册模型信号
+        from core_base import signals
+        # 检查缓存版本号所用的 cache 是否为共享缓存
+        from core_base.utils.cache_version import check_shared_cache
+        check_shared_cache()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
 from django.conf import settings
 from django.db import connection
 
@@ -15,22 +18,29 @@ def is_tenants_mode():
 # ******************** 初始化 ******************** #
 # ================================================= #
 def _get_all_dictionary():
+    """
+    获取字典配置快照
+    一次查询取出所有启用的字典, 在内存中按上级字典分组
+    :return:
+    """
     from core_base.models import Dictionary
 
-    queryset = Dictionary.objects.filter(status=True, is_value=False)
-    data = []
-    for instance in queryset:
-        data.append(
-            {
-                "id": instance.id,
-                "value": instance.value,
-                "children": list(
-                    Dictionary.objects.filter(parent=instance.id)
-                    .filter(status=1)
-                    .values("label", "value", "type", "color")
-                ),
-            }
+    queryset = (
+        Dictionary.objects.filter(status=True)
+        .order_by("sort", "id")
+        .values("id", "parent_id", "is_value", "label", "value", "type", "color")
+    )
+    parents = []
+    children_map = {}
+    for row in queryset:
+        if not row["is_value"]:
+            parents.append(row)
+        children_map.setdefault(row["parent_id"], []).append(
+            {"label": row["label"], "value": row["value"], "type": row["type"], "color": row["color"]}
         )
+    data = [
+        {"id": row["id"], "value": row["value"], "children": children_map.get(row["id"], [])} for row in parents
+    ]
     return {ele.get("value"): ele for ele in data}
 
 
@@ -51,6 +61,115 @@ def _get_all_system_config():
     return data
 
 
+# 字典/系统配置变更时递增的版本号名称
+DICTIONARY_VERSION = "dictionary"
+SYSTEM_CONFIG_VERSION = "system_config"
+# 当前进程已加载的配置版本号 {(版本名称, schema_name): 版本号}
+_loaded_versions = {}
+# deferred_refresh 期间待刷新的配置
+_deferred = threading.local()
+
+
+def _get_schema_name():
+    return connection.tenant.schema_name if is_tenants_mode() else None
+
+
+def _load_dictionary():
+    if is_tenants_mode():
+        settings.DICTIONARY_CONFIG[connection.tenant.schema_name] = _get_all_dictionary()
+    else:
+        settings.DICTIONARY_CONFIG = _get_all_dictionary()
+
+
+def _load_system_config():
+    if is_tenants_mode():
+        settings.SYSTEM_CONFIG[connection.tenant.schema_name] = _get_all_system_config()
+    else:
+        settings.SYSTEM_CONFIG = _get_all_system_config()
+
+
+def _load_config(name, loader):
+    """
+    加载当前 schema 的配置, 并记录加载时的版本号
+    :param name: 版本名称
+    :param loader: 加载函数
+    :return:
+    """
+    from core_base.utils.cache_version import get_version
+
+    # 先取版本号再加载, 加载期间版本变化时下一次读取会再次重建
+    version = get_version(name)
+    loader()
+    _loaded_versions[(name, _get_schema_name())] = version
+
+
+def _reload_if_stale(name, loader):
+    """
+    版本号变化时重建当前 schema 的配置
+    版本号的检查间隔由 CACHE_VERSION_CHECK_INTERVAL 控制, 未变化时不访问数据库
+    :param name: 版本名称
+    :param loader: 加载函数
+    :return:
+    """
+    from core_base.utils.cache_version import get_version
+
+    if _loaded_versions.get((name, _get_schema_name())) != get_version(name):
+        _load_config(name, loader)
+
+
+def _invalidate_config(name):
+    """
+    使当前 schema 的配置失效, 事务提交后递增版本号通知其它进程
+    :param name: 版本名称
+    :return:
+    """
+    from core_base.utils.cache_version import bump_version_on_commit
+
+    _loaded_versions.pop((name, _get_schema_name()), None)
+    bump_version_on_commit(name)
+
+
+@contextmanager
+def deferred_refresh():
+    """
+    合并刷新字典/系统配置
+    代码块内多次调用 refresh_dictionary/refresh_system_config 只记录待刷新项,
+    退出代码块时每项只刷新一次(版本号在事务提交后递增), 支持嵌套
+    例如:
+    with dispatch.deferred_refresh():
+        for instance in instances:
+            instance.save()
+    :return:
+    """
+    depth = getattr(_deferred, "depth", 0)
+    if depth == 0:
+        _deferred.pending = set()
+    _deferred.depth = depth + 1
+    try:
+        yield
+    finally:
+        _deferred.depth -= 1
+        if _deferred.depth == 0:
+            pending, _deferred.pending = _deferred.pending, None
+            if DICTIONARY_VERSION in pending:
+                refresh_dictionary()
+            if SYSTEM_CONFIG_VERSION in pending:
+                refresh_system_config()
+
+
+def _defer_refresh(name):
+    """
+    处于 deferred_refresh 代码块内时记录待刷新项
+    :param name: 版本名称
+    :return: 是否已延迟
+    """
+    pending = getattr(_deferred, "pending", None)
+    if pending is None:
+        return False
+    pending.add(name)
+    return True
+
+
 def init_dictionary():
     """
     初始化字典配置
@@ -62,9 +181,9 @@ def init_dictionary():
 
             for tenant in get_tenant_model().objects.filter():
                 with tenant_context(tenant):
-                    settings.DICTIONARY_CONFIG[connection.tenant.schema_name] = _get_all_dictionary()
+                    _load_config(DICTIONARY_VERSION, _load_dictionary)
         else:
-            settings.DICTIONARY_CONFIG = _get_all_dictionary()
+            _load_config(DICTIONARY_VERSION, _load_dictionary)
     except Exception as e:
         print("请先进行数据库迁移!")
     return
@@ -83,9 +202,9 @@ def init_system_config():
 
             for tenant in get_tenant_model().objects.filter():
                 with tenant_context(tenant):
-                    settings.SYSTEM_CONFIG[connection.tenant.schema_name] = _get_all_system_config()
+                    _load_config(SYSTEM_CONFIG_VERSION, _load_system_config)
         else:
-            settings.SYSTEM_CONFIG = _get_all_system_config()
+            _load_config(SYSTEM_CONFIG_VERSION, _load_system_config)
     except Exception as e:
         print("请先进行数据库迁移!")
     return
@@ -94,31 +213,37 @@ def init_system_config():
 def refresh_dictionary():
     """
     刷新字典配置
+    递增字典版本号, 所有进程在下一次读取时重建
     :return:
     """
+    if _defer_refresh(DICTIONARY_VERSION):
+        return
     if is_tenants_mode():
         from django_tenants.utils import tenant_context, get_tenant_model
 
         for tenant in get_tenant_model().objects.filter():
             with tenant_context(tenant):
-                settings.DICTIONARY_CONFIG[connection.tenant.schema_name] = _get_all_dictionary()
+                _invalidate_config(DICTIONARY_VERSION)
     else:
-        settings.DICTIONARY_CONFIG = _get_all_dictionary()
+        _invalidate_config(DICTIONARY_VERSION)
 
 
 def refresh_system_config():
     """
     刷新系统配置
+    递增系统配置版本号, 所有进程在下一次读取时重建
     :return:
     """
+    if _defer_refresh(SYSTEM_CONFIG_VERSION):
+        return
     if is_tenants_mode():
         from django_tenants.utils import tenant_context, get_tenant_model
 
         for tenant in get_tenant_model().objects.filter():
             with tenant_context(tenant):
-                settings.SYSTEM_CONFIG[connection.tenant.schema_name] = _get_all_system_config()
+                _invalidate_config(SYSTEM_CONFIG_VERSION)
     else:
-        settings.SYSTEM_CONFIG = _get_all_system_config()
+        _invalidate_config(SYSTEM_CONFIG_VERSION)
 
 
 # ================================================= #
@@ -130,8 +255,10 @@ def get_dictionary_config(schema_name=None):
     :param schema_name: 对应字典配置的租户schema_name值
     :return:
     """
+    if not schema_name or schema_name == _get_schema_name():
+        _reload_if_stale(DICTIONARY_VERSION, _load_dictionary)
     if is_tenants_mode():
-        dictionary_config = settings.DICTIONARY_CONFIG[schema_name or connection.tenant.schema_name]
+        dictionary_config = settings.DICTIONARY_CONFIG.get(schema_name or connection.tenant.schema_name)
     else:
         dictionary_config = settings.DICTIONARY_CONFIG
     return dictionary_config or {}
@@ -174,8 +301,10 @@ def get_system_config(schema_name=None):
     :param schema_name: 对应字典配置的租户schema_name值
     :return:
     """
+    if not schema_name or schema_name == _get_schema_name():
+        _reload_if_stale(SYSTEM_CONFIG_VERSION, _load_system_config)
     if is_tenants_mode():
-        dictionary_config = settings.SYSTEM_CONFIG[schema_name or connection.tenant.schema_name]
+        dictionary_config = settings.SYSTEM_CONFIG.get(schema_name or connection.tenant.schema_name)
     else:
         dictionary_config = settings.SYSTEM_CONFIG
     return dictionary_config or {}
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 from django.apps import apps
+from django.conf import settings as django_settings
 from django.db.models import QuerySet
+from django.db.models.signals import post_save
+from django.db.models.expressions import Col
+from django.db.models.query_utils import DeferredAttribute
+from django.core.exceptions import FieldError
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from core_base import settings, dispatch
 import hashlib
+import hmac
 import os, uuid, json
 from core_base.utils import encrypt_model_field
+from core_base.utils.validator import CustomValidationError
 
 # 表前缀
 table_prefix = settings.TABLE_PREFIX
@@ -101,18 +108,249 @@ def rename(newname):
 
 # 自动加解密
 rsaUtil = encrypt_model_field.RsaUtil()
+envelopeUtil = encrypt_model_field.EnvelopeUtil(rsaUtil)
+
+
+def encrypt_field_value(value):
+    """
+    加密字段值
+    ENCRYPT_FIELD_VERSION 为 1 时使用 RSA 分段加密, 否则使用信封加密(AES-GCM)
+    """
+    message = json.dumps(value)
+    if getattr(django_settings, "ENCRYPT_FIELD_VERSION", 2) == 1:
+        return rsaUtil.encrypt_by_public_key(message)
+    return envelopeUtil.encrypt(message)
+
+
+def decrypt_field_value(value):
+    """
+    解密字段值, 根据密文版本头自动选择解密方式
+    """
+    if isinstance(value, bytes):
+        value = value.decode(encoding='utf-8')
+    if envelopeUtil.is_envelope(value):
+        return json.loads(envelopeUtil.decrypt(value))
+    return json.loads(rsaUtil.decrypt_by_private_key(value))
+
+
+class EncryptedValue(object):
+    """
+    延迟解密的字段值, 保存密文, 首次读取 value 时解密并缓存明文
+    只出现在模型实例的 __dict__ 中, 通过 EncryptedFieldDescriptor 访问字段时自动取得明文
+    """
+    __slots__ = ("ciphertext", "_value")
+    _UNSET = object()
+
+    def __init__(self, ciphertext):
+        self.ciphertext = ciphertext
+        self._value = self._UNSET
+
+    @property
+    def value(self):
+        if self._value is self._UNSET:
+            self._value = decrypt_field_value(self.ciphertext)
+        return self._value
+
+    def __getstate__(self):
+        # 只序列化密文, 反序列化后重新延迟解密
+        return self.ciphertext
+
+    def __setstate__(self, state):
+        self.ciphertext = state
+        self._value = self._UNSET
+
+    def __eq__(self, other):
+        if isinstance(other, EncryptedValue):
+            other = other.value
+        return self.value == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<EncryptedValue>"
+
+
+class EncryptedCol(Col):
+    """
+    加密字段的查询列
+    只有加载到模型实例上的默认列返回 EncryptedValue 延迟解密, values()/values_list()/annotate() 等直接返回明文
+    """
+
+    def __init__(self, alias, target, output_field=None):
+        super().__init__(alias, target, output_field)
+        self.lazy = False
+
+    def select_format(self, compiler, sql, params):
+        # 模型查询的默认列每次编译都重新生成, 可以按本次查询标记, annotate() 的列不加载到字段上
+        query = compiler.query
+        self.lazy = query.default_cols and all(annotation is not self for annotation in query.annotation_select.values())
+        return super().select_format(compiler, sql, params)
+
+
+class EncryptedFieldDescriptor(DeferredAttribute):
+    """
+    加密字段描述符: 首次访问字段时解密, 并将明文缓存在实例上
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, EncryptedValue):
+            value = value.value
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+        # 修改明文时同步盲索引, bulk_update 指定盲索引列即可写入
+        if self.field.blind_index and not isinstance(value, EncryptedValue):
+            instance.__dict__[self.field.blind_index_name] = self.field.get_blind_index(value)
+
+
+# 盲索引列名后缀
+BLIND_INDEX_SUFFIX = "_bidx"
+
+
+class BlindIndexField(models.CharField):
+    """
+    加密字段的盲索引列, 由 EncrypyField(blind_index=True) 自动添加并维护
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 64)
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("blank", True)
+        kwargs.setdefault("db_index", True)
+        kwargs.setdefault("editable", False)
+        super().__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        # 迁移文件中的盲索引列与 EncrypyField 自动添加的列只保留一个
+        if name not in [field.name for field in cls._meta.local_fields]:
+            super().contribute_to_class(cls, name, *args, **kwargs)
+
+    def get_source_field(self):
+        """
+        盲索引对应的加密字段
+        """
+        return self.model._meta.get_field(self.name[:-len(BLIND_INDEX_SUFFIX)])
+
+    def pre_save(self, model_instance, add):
+        # 保存时按加密字段的明文计算盲索引, 加密字段未加载(only/defer)时保留原值
+        source = self.get_source_field()
+        if source.attname not in model_instance.__dict__:
+            return getattr(model_instance, self.attname)
+        value = model_instance.__dict__[source.attname]
+        if isinstance(value, EncryptedValue):
+            value = value.value
+        index = source.get_blind_index(value)
+        setattr(model_instance, self.attname, index)
+        return index
+
+
+def update_blind_index(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    """
+    save(update_fields=...) 包含开启盲索引的加密字段但未包含盲索引列时, 补充更新盲索引列
+    """
+    if raw or not update_fields:
+        return
+    values = {}
+    for field in sender._meta.concrete_fields:
+        if not isinstance(field, BlindIndexField) or field.name in update_fields:
+            continue
+        source = field.get_source_field()
+        if source.name in update_fields or source.attname in update_fields:
+            values[field.attname] = field.pre_save(instance, False)
+    if values:
+        sender._base_manager.using(using).filter(pk=instance.pk).update(**values)
 
 
 class EncrypyField(models.TextField):
+    """
+    自动加解密字段
+    (1)加载到模型实例时只保留密文, 首次访问字段时才解密, 未访问的字段不产生解密开销; values()/values_list() 返回明文
+    (2)未访问过的字段保存时原样写回密文
+    (3)blind_index=True 时自动添加 <字段名>_bidx 盲索引列(HMAC-SHA256), 支持 field__blind_exact=value 等值查询
+       盲索引在 save()/bulk_create() 时由 BlindIndexField.pre_save 计算, save(update_fields=[字段]) 时补充更新盲索引
+       bulk_update() 需在 fields 中同时指定 <字段名>_bidx, QuerySet.update() 不会更新盲索引
+       已有数据使用 reencrypt_fields --blind-index 重建; 盲索引列不会出现在 CustomModelSerializer 的输出中
+    """
+    descriptor_class = EncryptedFieldDescriptor
+
+    def __init__(self, *args, blind_index=False, **kwargs):
+        self.blind_index = blind_index
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.blind_index:
+            kwargs["blind_index"] = True
+        return name, path, args, kwargs
+
+    @property
+    def blind_index_name(self):
+        return f"{self.name}{BLIND_INDEX_SUFFIX}"
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super().contribute_to_class(cls, name, *args, **kwargs)
+        if self.blind_index and not cls._meta.abstract:
+            BlindIndexField().contribute_to_class(cls, self.blind_index_name)
+            post_save.connect(update_blind_index, sender=cls, dispatch_uid=f"update_blind_index:{cls.__module__}.{cls.__qualname__}")
+
+    def get_blind_index(self, value):
+        """
+        计算盲索引, 字符串按原值计算, 其它类型按 json 计算
+        :param value: 明文
+        :return:
+        """
+        if value is None:
+            return None
+        message = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+        key = getattr(django_settings, "ENCRYPT_BLIND_INDEX_KEY", None) or django_settings.SECRET_KEY
+        return hmac.new(key.encode(), f"{self.name}:{message}".encode(), hashlib.sha256).hexdigest()
+
+    def pre_save(self, model_instance, add):
+        # 未访问过的字段原样写回密文, 盲索引由 BlindIndexField.pre_save 计算
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, EncryptedValue):
+            return value
+        return super().pre_save(model_instance, add)
+
+    def get_col(self, alias, output_field=None):
+        # 每次返回新的列对象, 以便按查询区分是否延迟解密
+        return EncryptedCol(alias, self, output_field)
+
     def get_db_prep_value(self, value, connection, prepared=False):
         # 保存到数据库加密
-        return rsaUtil.encrypt_by_public_key(json.dumps(value))
+        if isinstance(value, EncryptedValue):
+            return value.ciphertext
+        return encrypt_field_value(value)
 
     def from_db_value(self, value, expression, connection):
-        # 从数据库中读取解密
-        if value:
-            return json.loads(rsaUtil.decrypt_by_private_key(value))
-        return value
+        # 从数据库中读取, 加载到模型实例时访问字段才解密, 其它查询直接解密
+        if not value:
+            return value
+        if getattr(expression, "lazy", False):
+            return EncryptedValue(value)
+        return decrypt_field_value(value)
+
+
+@EncrypyField.register_lookup
+class BlindExact(models.Lookup):
+    """
+    加密字段盲索引等值查询: field__blind_exact=value
+    """
+    lookup_name = "blind_exact"
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        field = self.lhs.output_field
+        if not field.blind_index:
+            raise FieldError(f"{field.name} 未开启盲索引(blind_index=True)")
+        index_field = field.model._meta.get_field(field.blind_index_name)
+        lhs_sql, params = compiler.compile(index_field.get_col(self.lhs.alias))
+        return f"{lhs_sql} = %s", [*params, field.get_blind_index(self.rhs)]
 
 
 # 所有models指定数据库名称
@@ -240,6 +478,34 @@ class Role(CoreModel, specifyDB):
         ordering = ("sort",)
 
 
+class DeptManager(SoftDeleteManager):
+    """
+    部门管理器, 基于部门闭包表查询上下级部门
+    """
+
+    def descendants(self, dept_id, include_self=True):
+        """
+        获取部门的所有下级部门
+        :param dept_id: 部门id或部门id列表
+        :param include_self: 是否包含部门本身
+        :return: QuerySet
+        """
+        closure = DeptClosure.objects.descendants_of(dept_id, include_self)
+        return self.filter(id__in=closure.values("descendant_id"))
+
+    def ancestors(self, dept_id, include_self=True):
+        """
+        获取部门的所有上级部门
+        :param dept_id: 部门id
+        :param include_self: 是否包含部门本身
+        :return: QuerySet
+        """
+        closure = DeptClosure.objects.filter(descendant_id=dept_id)
+        if not include_self:
+            closure = closure.filter(depth__gt=0)
+        return self.filter(id__in=closure.values("ancestor_id"))
+
+
 class Dept(CoreModel, specifyDB):
     name = models.CharField(max_length=64, verbose_name="部门名称", help_text="部门名称")
     sort = models.IntegerField(default=1, verbose_name="显示排序", help_text="显示排序")
@@ -256,6 +522,7 @@ class Dept(CoreModel, specifyDB):
         blank=True,
         help_text="上级部门",
     )
+    objects = DeptManager()
 
     class Meta:
         db_table = table_prefix + "system_dept"
@@ -263,6 +530,124 @@ class Dept(CoreModel, specifyDB):
         verbose_name_plural = verbose_name
         ordering = ("sort",)
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # 同步维护部门闭包表, 使用 queryset.update 修改上级部门时不会同步, 需执行 rebuild_dept_closure
+        adding = self._state.adding or self.pk is None
+        old_parent_id = None
+        if not adding:
+            old_parent_id = Dept._base_manager.filter(pk=self.pk).values_list("parent_id", flat=True).first()
+        with transaction.atomic(using=using):
+            super().save(force_insert, force_update, using, update_fields)
+            if adding or not DeptClosure.objects.filter(ancestor_id=self.pk, descendant_id=self.pk).exists():
+                DeptClosure.objects.insert_node(self.pk, self.parent_id)
+            elif old_parent_id != self.parent_id:
+                DeptClosure.objects.move_node(self.pk, self.parent_id)
+
+
+class DeptClosureManager(models.Manager):
+    """
+    部门闭包表维护
+    """
+
+    def descendants_of(self, dept_id, include_self=True):
+        """
+        部门与其所有下级部门的关联, 已软删除的部门及其下级部门不包含在内
+        :param dept_id: 部门id或部门id列表
+        :param include_self: 是否包含部门本身
+        :return: QuerySet
+        """
+        closure = self.filter(**{
+            "ancestor_id__in" if isinstance(dept_id, (list, tuple, set)) else "ancestor_id": dept_id
+        })
+        # 软删除通过 queryset.update 完成, 不会同步闭包表, 查询时排除已删除部门的整个子树
+        deleted_ids = closure.filter(descendant__is_deleted=True).values("descendant_id")
+        closure = closure.exclude(descendant_id__in=self.filter(ancestor_id__in=deleted_ids).values("descendant_id"))
+        if not include_self:
+            closure = closure.filter(depth__gt=0)
+        return closure
+
+    def insert_node(self, dept_id, parent_id=None):
+        """
+        新增部门: 写入自身关联及上级部门所有祖先的关联
+        """
+        links = [self.model(ancestor_id=dept_id, descendant_id=dept_id, depth=0)]
+        if parent_id:
+            links.extend(
+                self.model(ancestor_id=ancestor_id, descendant_id=dept_id, depth=depth + 1)
+                for ancestor_id, depth in self.filter(descendant_id=parent_id).values_list("ancestor_id", "depth")
+            )
+        self.bulk_create(links)
+
+    def move_node(self, dept_id, parent_id=None):
+        """
+        调整上级部门: 断开子树与原祖先的关联, 再与新上级部门的祖先建立关联
+        """
+        subtree = list(self.filter(ancestor_id=dept_id).values_list("descendant_id", "depth"))
+        subtree_ids = [descendant_id for descendant_id, depth in subtree]
+        if parent_id in subtree_ids:
+            raise CustomValidationError("不能将部门的上级部门设置为自身或其下级部门")
+        self.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if parent_id:
+            ancestors = list(self.filter(descendant_id=parent_id).values_list("ancestor_id", "depth"))
+            self.bulk_create(
+                [
+                    self.model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+                    for ancestor_id, ancestor_depth in ancestors
+                    for descendant_id, depth in subtree
+                ],
+                batch_size=1000,
+            )
+
+    def rebuild(self, batch_size=1000):
+        """
+        根据部门表的上级部门全量重建闭包表
+        :return: 写入的关联数量
+        """
+        parents = dict(Dept._base_manager.values_list("id", "parent_id"))
+        links = []
+        for dept_id in parents:
+            ancestor_id, depth, visited = dept_id, 0, set()
+            while ancestor_id is not None and ancestor_id in parents and ancestor_id not in visited:
+                links.append(self.model(ancestor_id=ancestor_id, descendant_id=dept_id, depth=depth))
+                visited.add(ancestor_id)
+                ancestor_id = parents[ancestor_id]
+                depth += 1
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(links, batch_size=batch_size)
+        return len(links)
+
+
+class DeptClosure(specifyDB):
+    """
+    部门闭包表, 记录每个部门与其所有上级部门(含自身)的关联及层级差
+    """
+    ancestor = models.ForeignKey(
+        to="Dept",
+        related_name="closure_descendants",
+        on_delete=models.CASCADE,
+        db_constraint=False,
+        verbose_name="上级部门",
+        help_text="上级部门",
+    )
+    descendant = models.ForeignKey(
+        to="Dept",
+        related_name="closure_ancestors",
+        on_delete=models.CASCADE,
+        db_constraint=False,
+        verbose_name="下级部门",
+        help_text="下级部门",
+    )
+    depth = models.IntegerField(default=0, verbose_name="层级差", help_text="层级差")
+    objects = DeptClosureManager()
+
+    class Meta:
+        db_table = table_prefix + "system_dept_closure"
+        verbose_name = "部门闭包表"
+        verbose_name_plural = verbose_name
+        unique_together = (("ancestor", "descendant"),)
+        indexes = [models.Index(fields=["descendant", "depth"])]
+
 
 class Menu(CoreModel, specifyDB):
     parent = models.ForeignKey(
@@ -483,6 +868,25 @@ class Logs(CoreModel, specifyDB):
         ordering = ("-create_datetime",)
 
 
+class LoginLogQueue(specifyDB):
+    """
+    待处理的登录日志, 异步写入登录日志失败或进程退出时保存登录的原始信息, 由后台线程或 flush_login_logs 命令重新写入
+    """
+    id = models.BigAutoField(primary_key=True, help_text="Id", verbose_name="Id")
+    username = models.CharField(max_length=150, verbose_name="用户名", null=True, blank=True, help_text="用户名")
+    creator = models.CharField(max_length=255, null=True, blank=True, help_text="用户id", verbose_name="用户id")
+    dept_belong_id = models.CharField(max_length=255, null=True, blank=True, help_text="用户部门", verbose_name="用户部门")
+    request_ip = models.CharField(max_length=64, verbose_name="请求ip地址", null=True, blank=True, help_text="请求ip地址")
+    request_agent = models.TextField(verbose_name="User-Agent", null=True, blank=True, help_text="User-Agent")
+    login_datetime = models.DateTimeField(verbose_name="登录时间", help_text="登录时间")
+
+    class Meta:
+        db_table = table_prefix + "system_login_log_queue"
+        verbose_name = "待处理登录日志"
+        verbose_name_plural = verbose_name
+        ordering = ("id",)
+
+
 class MessageCenter(CoreModel, specifyDB):
     title = models.CharField(max_length=100, verbose_name="标题", help_text="标题")
     content = models.TextField(verbose_name="内容", help_text="内容")
@@ -19,6 +19,25 @@ SECRET_KEY = 'django-insecure-no%8z#s@7=%-6+yw5c(88!qo8)!xc#$gmez$g3s6wmdkszdhg*
 API_LOG_ENABLE = True
 # API_LOG_METHODS = 'ALL'
 API_LOG_METHODS = ["POST", "UPDATE", "DELETE", "PUT"]  # ['POST', 'DELETE']
+# 日志异步批量写入
+API_LOG_ASYNC = False
+# 日志队列最大长度
+API_LOG_QUEUE_SIZE = 10000
+# 每批写入的日志数量
+API_LOG_BATCH_SIZE = 200
+# 日志最长写入间隔(秒)
+API_LOG_FLUSH_INTERVAL = 1
+# 日志队列已满时的处理方式: drop_new 丢弃新日志, drop_oldest 丢弃最旧日志, sync 同步写入
+API_LOG_DROP_POLICY = "drop_new"
+# 不记录日志的接口(正则), 例如: [r"^/api/system/log/"]
+API_LOG_SKIP_PATHS = []
+# 日志采样率(0~1), API_LOG_SAMPLE_RATES 按接口(正则)单独配置, 例如: {r"^/api/system/user/": 0.1}
+API_LOG_SAMPLE_RATE = 1
+API_LOG_SAMPLE_RATES = {}
+# 请求参数/返回信息保存的最大字节数, 超出时压缩(API_LOG_COMPRESS 为 True)或截断
+API_LOG_BODY_MAX_BYTES = 10240
+API_LOG_RESULT_MAX_BYTES = 10240
+API_LOG_COMPRESS = False
 API_MODEL_MAP = {
     "/token/": "登录模块",
     "/api/login/": "登录模块",
@@ -37,6 +56,66 @@ SYSTEM_CONFIG = {}
 # 字典配置
 DICTIONARY_CONFIG = {}
 # ================================================= #
+# ******************** 缓存配置 ******************** #
+# ================================================= #
+# 保存跨进程缓存版本号所用的 cache 别名, 多 worker/多节点部署时必须配置为 redis 等共享缓存
+# 权限、菜单、字典、数据权限、分页总数及令牌权限摘要的失效都依赖该版本号, LocMemCache/DummyCache 时启动会输出警告
+CACHE_VERSION_ALIAS = "default"
+# 各进程检查缓存版本号的最小间隔(秒)
+CACHE_VERSION_CHECK_INTERVAL = 1
+# 序列化创建人/修改人姓名时缓存的用户数量及过期秒数
+USER_NAME_CACHE_SIZE = 10000
+USER_NAME_CACHE_TTL = 300
+# 用户数据权限范围缓存秒数(共享 cache), 角色/部门变更时通过版本号失效
+DATA_SCOPE_CACHE_TTL = 3600
+# 数据权限部门数量不超过该值时缓存部门id集合并直接过滤, 超过时使用子查询过滤
+DATA_SCOPE_INLINE_LIMIT = 500
+# 分页总数统计方式: exact 精确统计, cached 精确统计并缓存(数据变更后失效), estimated 无过滤条件时按数据库统计信息估算
+# cached 方式只按列表模型自身的写入版本号失效, 过滤条件含关联查询或子查询时不缓存, 直接精确统计
+# 未触发信号的写入(QuerySet.update()/delete()、bulk_create 等)在 PAGINATION_COUNT_CACHE_TTL 秒内可能返回旧的总数
+PAGINATION_COUNT_STRATEGY = "exact"
+# 启用总数缓存的模型(如 ["core_base.Logs"]), None 表示 PAGINATION_COUNT_STRATEGY 不为 exact 时启用 core_base 的全部模型
+# 未启用的模型总是精确统计
+PAGINATION_COUNT_CACHE_MODELS = None
+# cached 方式总数缓存秒数
+PAGINATION_COUNT_CACHE_TTL = 60
+# estimated 方式估算数量小于该值时仍精确统计
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 10000
+# User-Agent 解析结果进程内缓存条数
+USER_AGENT_CACHE_SIZE = 2048
+# 认证用户进程内短时缓存(UserAuthentication/CustomJWTAuthentication), 用户保存/删除/角色变更时失效
+USER_SNAPSHOT_CACHE = False
+USER_SNAPSHOT_CACHE_SIZE = 10000
+USER_SNAPSHOT_CACHE_TTL = 5
+# 登录令牌中写入权限摘要(角色、数据权限范围、部门、权限版本号), 权限版本号未变化时鉴权不再查询角色
+# 仅在 CACHE_VERSION_ALIAS 为共享缓存时生效, 否则忽略令牌中的权限摘要并从数据库查询
+AUTH_CLAIMS = False
+# ================================================= #
+# ******************** 加密配置 ******************** #
+# ================================================= #
+# EncrypyField 写入格式: 2 信封加密(AES-GCM 数据密钥 + RSA 加密数据密钥), 1 RSA 分段加密; 两种格式均可读取
+ENCRYPT_FIELD_VERSION = 2
+# EncrypyField 盲索引 HMAC 密钥, 为空时使用 SECRET_KEY; 修改后需执行 python manage.py reencrypt_fields --blind-index 重建盲索引
+ENCRYPT_BLIND_INDEX_KEY = None
+# ================================================= #
+# ******************** 登录日志 ******************** #
+# ================================================= #
+# 是否解析登录IP所在地区
+ENABLE_LOGIN_ANALYSIS_LOG = True
+# 离线IP地址库索引文件路径, 通过 python manage.py build_ip_location 生成
+IP_LOCATION_DB_PATH = None
+# 离线地址库未命中时使用的远程IP解析接口, 为空时不调用, 例如: https://ip.django-vue-admin.com/ip/analysis
+IP_ANALYSIS_REMOTE_URL = None
+IP_ANALYSIS_REMOTE_TIMEOUT = 2
+# 是否异步写入登录日志: 登录请求只记录原始信息, 后台线程解析归属地后批量写入, 未处理的数据保存在 LoginLogQueue 表
+# 开启前需执行 python manage.py makemigrations core_base && python manage.py migrate 创建 LoginLogQueue 表
+LOGIN_LOG_ASYNC = False
+# 解析登录日志的线程数
+LOGIN_LOG_WORKERS = 2
+LOGIN_LOG_QUEUE_SIZE = 10000
+LOGIN_LOG_BATCH_SIZE = 100
+LOGIN_LOG_FLUSH_INTERVAL = 1
+# ================================================= #
 # ******************** 插件配置 ******************** #
 # ================================================= #
 # 租户共享app
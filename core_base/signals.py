@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+模型信号
+数据变更后递增对应的缓存版本号, 使各进程的本地缓存失效
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from core_base import dispatch
+from core_base.models import Role, Menu, MenuButton, ApiWhiteList, Users, SystemConfig, Dept
+from core_base.utils.authentication import invalidate_user_snapshot
+from core_base.utils.cache_version import bump_version_on_commit, get_model_version_name
+from core_base.utils.data_scope import AUTH_VERSION
+from core_base.utils.menu_tree import MENU_VERSION
+from core_base.utils.pagination import get_count_cache_models
+from core_base.utils.permission import PERMISSION_VERSION, API_WHITE_LIST_VERSION
+from core_base.utils.serializers import invalidate_user_name
+
+M2M_CHANGED_ACTIONS = ("post_add", "post_remove", "post_clear")
+
+
+# 模型/多对多中间表对应的缓存版本号, 数据变更后递增
+MODEL_VERSIONS = {
+    Role: (PERMISSION_VERSION, MENU_VERSION, AUTH_VERSION),
+    MenuButton: (PERMISSION_VERSION, MENU_VERSION),
+    Menu: (MENU_VERSION,),
+    Dept: (AUTH_VERSION,),
+    ApiWhiteList: (API_WHITE_LIST_VERSION,),
+}
+RELATION_VERSIONS = {
+    Role.permission.through: (PERMISSION_VERSION,),
+    Role.menu.through: (MENU_VERSION,),
+    Role.dept.through: (AUTH_VERSION,),
+    Users.role.through: (PERMISSION_VERSION, AUTH_VERSION),
+}
+
+
+def refresh_versions(sender, **kwargs):
+    bump_version_on_commit(*MODEL_VERSIONS[sender])
+
+
+def refresh_relation_versions(sender, action, **kwargs):
+    if action in M2M_CHANGED_ACTIONS:
+        bump_version_on_commit(*RELATION_VERSIONS[sender])
+
+
+for version_model in MODEL_VERSIONS:
+    post_save.connect(refresh_versions, sender=version_model)
+    post_delete.connect(refresh_versions, sender=version_model)
+for version_through in RELATION_VERSIONS:
+    m2m_changed.connect(refresh_relation_versions, sender=version_through)
+
+
+@receiver([post_save, post_delete], sender=SystemConfig)
+def refresh_system_config(sender, **kwargs):
+    dispatch.refresh_system_config()
+
+
+@receiver([post_save, post_delete], sender=Users)
+def refresh_user_name(sender, instance, **kwargs):
+    invalidate_user_name(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Users)
+def refresh_user_snapshot(sender, instance, **kwargs):
+    invalidate_user_snapshot(instance.id)
+
+
+@receiver(m2m_changed, sender=Users.role.through)
+def refresh_user_snapshot_role(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_CHANGED_ACTIONS:
+        return
+    if not reverse:
+        invalidate_user_snapshot(instance.id)
+    elif pk_set:
+        for user_id in pk_set:
+            invalidate_user_snapshot(user_id)
+    else:
+        invalidate_user_snapshot()
+
+
+def refresh_model_version(sender, **kwargs):
+    # 模型写入版本号, 用于分页总数缓存失效
+    bump_version_on_commit(get_model_version_name(sender))
+
+
+# 只为启用总数缓存的模型注册
+for count_cache_model in get_count_cache_models():
+    post_save.connect(refresh_model_version, sender=count_cache_model)
+    post_delete.connect(refresh_model_version, sender=count_cache_model)
+
+
+def refresh_bulk_write(model, pks=None, m2m_fields=()):
+    """
+    bulk_create/bulk_update/批量写入中间表不会触发信号, 写入后按信号的对应关系手动刷新缓存
+    :param model: 写入的模型
+    :param pks: 写入数据的主键, None 表示未知
+    :param m2m_fields: 写入了中间表的多对多字段
+    :return:
+    """
+    names = set(MODEL_VERSIONS.get(model, ()))
+    for field in m2m_fields:
+        names.update(RELATION_VERSIONS.get(field.remote_field.through, ()))
+    if model in get_count_cache_models():
+        names.add(get_model_version_name(model))
+    if names:
+        bump_version_on_commit(*names)
+    if model is SystemConfig:
+        dispatch.refresh_system_config()
+    if model is not Users:
+        return
+    if pks is None:
+        invalidate_user_snapshot()
+        return
+    for user_id in pks:
+        invalidate_user_name(user_id)
+        invalidate_user_snapshot(user_id)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core_base.utils.ip_location import build_index
+
+
+class Command(BaseCommand):
+    """
+    生成离线IP地址库索引: python manage.py build_ip_location ip.csv
+    CSV 表头: start_ip,end_ip,continent,country,province,city,district,isp,area_code,country_english,country_code,longitude,latitude
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_path", type=str, help="IP段 CSV 文件路径")
+        parser.add_argument("--output", type=str, default=None, help="索引文件路径, 默认 IP_LOCATION_DB_PATH")
+        parser.add_argument("--encoding", type=str, default="utf-8", help="CSV 文件编码")
+
+    def handle(self, *args, **options):
+        output = options.get("output") or getattr(settings, "IP_LOCATION_DB_PATH", None)
+        if not output:
+            raise CommandError("请通过 --output 或 IP_LOCATION_DB_PATH 指定索引文件路径")
+        count = build_index(options.get("csv_path"), output, encoding=options.get("encoding"))
+        print(f"IP地址库索引生成完成, 共{count}个IP段: {output}")
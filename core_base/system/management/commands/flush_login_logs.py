@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core_base import dispatch
+from core_base.utils.login_log import get_login_log_pipeline
+
+
+class Command(BaseCommand):
+    """
+    处理待处理登录日志: python manage.py flush_login_logs
+    将 LoginLogQueue 中未写入的登录信息解析后写入系统日志, 租户模式下需定时执行
+    """
+
+    def flush(self):
+        count = get_login_log_pipeline().recover()
+        print(f"待处理登录日志处理完成, 共{count}条")
+
+    def handle(self, *args, **options):
+        if dispatch.is_tenants_mode():
+            from django_tenants.utils import get_tenant_model
+            from django_tenants.utils import tenant_context
+            for tenant in get_tenant_model().objects.exclude(schema_name='public'):
+                with tenant_context(tenant):
+                    print(f"租户[{connection.tenant.schema_name}]处理待处理登录日志开始...")
+                    self.flush()
+        else:
+            self.flush()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core_base import dispatch
+from core_base.models import DeptClosure
+from core_base.utils.cache_version import bump_version
+from core_base.utils.data_scope import AUTH_VERSION
+
+
+class Command(BaseCommand):
+    """
+    重建部门闭包表: python manage.py rebuild_dept_closure
+    首次升级或通过 queryset.update 批量修改上级部门后执行
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批写入的关联数量")
+
+    def rebuild(self, batch_size):
+        count = DeptClosure.objects.rebuild(batch_size=batch_size)
+        # 部门层级变化后用户的数据权限范围需要重新解析
+        bump_version(AUTH_VERSION)
+        print(f"部门闭包表重建完成, 共写入{count}条关联")
+
+    def handle(self, *args, **options):
+        batch_size = options.get("batch_size")
+        if dispatch.is_tenants_mode():
+            from django_tenants.utils import get_tenant_model
+            from django_tenants.utils import tenant_context
+            for tenant in get_tenant_model().objects.exclude(schema_name='public'):
+                with tenant_context(tenant):
+                    print(f"租户[{connection.tenant.schema_name}]重建部门闭包表开始...")
+                    self.rebuild(batch_size)
+        else:
+            self.rebuild(batch_size)
@@ -0,0 +1,92 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.db.models.functions import Cast
+
+from core_base import dispatch
+from core_base.models import EncrypyField, envelopeUtil, decrypt_field_value
+
+
+class Command(BaseCommand):
+    """
+    加密字段重新加密: python manage.py reencrypt_fields
+    将 EncrypyField 中的旧格式(RSA 分段加密)数据按批重新加密为当前 ENCRYPT_FIELD_VERSION 的格式
+    --blind-index 时同时重建开启盲索引字段的盲索引(新增盲索引或修改 ENCRYPT_BLIND_INDEX_KEY 后执行)
+    例如：
+    全部模型：python manage.py reencrypt_fields
+    指定模型：python manage.py reencrypt_fields core_base.Users
+    重建盲索引：python manage.py reencrypt_fields --blind-index
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="*", type=str, help="app_label.ModelName")
+        parser.add_argument("--batch-size", type=int, default=500, help="每批处理的数据量")
+        parser.add_argument("--all", action="store_true", help="已是信封加密格式的数据也重新加密")
+        parser.add_argument("--blind-index", action="store_true", help="重建盲索引")
+
+    def get_models(self, labels):
+        if labels:
+            return [apps.get_model(label) for label in labels]
+        return [model for model in apps.get_models() if self.get_encrypt_fields(model)]
+
+    def get_encrypt_fields(self, model):
+        return [field for field in model._meta.concrete_fields if isinstance(field, EncrypyField)]
+
+    def reencrypt_model(self, model, batch_size, reencrypt_all, rebuild_index=False):
+        fields = self.get_encrypt_fields(model)
+        if not fields:
+            return 0
+        # 通过 Cast 读取原始密文, 避免 from_db_value 解密后无法判断密文格式
+        raw_fields = {f"_raw_{field.attname}": Cast(field.attname, models.TextField()) for field in fields}
+        queryset = model._base_manager.annotate(**raw_fields).values_list("pk", *raw_fields.keys()).order_by("pk")
+        count = 0
+        last_pk = None
+        while True:
+            batch_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(batch_queryset[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            objs = []
+            for pk, *raw_values in rows:
+                values = {}
+                for field, raw_value in zip(fields, raw_values):
+                    reencrypt = raw_value and (reencrypt_all or not envelopeUtil.is_envelope(raw_value))
+                    rebuild = rebuild_index and field.blind_index
+                    if not reencrypt and not rebuild:
+                        continue
+                    value = decrypt_field_value(raw_value) if raw_value else None
+                    if reencrypt:
+                        values[field.attname] = value
+                    if rebuild:
+                        values[field.blind_index_name] = field.get_blind_index(value)
+                if values:
+                    objs.append((model(pk=pk, **values), values.keys()))
+            for update_fields in {tuple(keys) for obj, keys in objs}:
+                with transaction.atomic():
+                    model._base_manager.bulk_update(
+                        [obj for obj, keys in objs if tuple(keys) == update_fields], list(update_fields)
+                    )
+            count += len(objs)
+        print(f"[{model._meta.label}]重新加密{'及重建盲索引' if rebuild_index else ''}完成, 共{count}条数据")
+        return count
+
+    def handle(self, *args, **options):
+        batch_size = options.get("batch_size")
+        reencrypt_all = options.get("all")
+        rebuild_index = options.get("blind_index")
+        model_list = self.get_models(options.get("models"))
+
+        def run():
+            for model in model_list:
+                self.reencrypt_model(model, batch_size, reencrypt_all, rebuild_index)
+
+        if dispatch.is_tenants_mode():
+            from django_tenants.utils import get_tenant_model
+            from django_tenants.utils import tenant_context
+            for tenant in get_tenant_model().objects.exclude(schema_name='public'):
+                with tenant_context(tenant):
+                    print(f"租户[{connection.tenant.schema_name}]重新加密开始...")
+                    run()
+        else:
+            run()
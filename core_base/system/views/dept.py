@@ -102,10 +102,24 @@ class DeptCreateUpdateSerializer(CustomModelSerializer):
         fields = '__all__'
 
 
-# 递归获取菜单
-def get_child_dept(childs):
+def get_dept_children_map(dept_ids):
+    """
+    一次查询获取部门的所有下级部门, 并按上级部门分组
+    :param dept_ids: 部门id列表
+    :return: {上级部门id: [下级部门, ...]}
+    """
+    children_map = {}
+    queryset = Dept.objects.descendants(dept_ids, include_self=False).select_related('parent').order_by('sort')
+    for dept in queryset:
+        children_map.setdefault(dept.parent_id, []).append(dept)
+    return children_map
+
+
+# 递归获取部门
+def get_child_dept(childs, children_map=None):
     '''
     :param 当前节点:
+    :param children_map: get_dept_children_map 的结果, 不传时逐级查询下级部门
     :return [{"id": child.id, "title": child.title, "children": []}]:
     '''
     children = []
@@ -115,9 +129,12 @@ def get_child_dept(childs):
                     "name": child.name, "status": child.status,
                     "sort": child.sort, "parent": child.parent.id if child.parent else "",
                     "parentName": child.parent.name if child.parent else "", "owner": child.owner}
-            _childs = Dept.objects.filter(parent=child)
+            if children_map is None:
+                _childs = Dept.objects.filter(parent=child)
+            else:
+                _childs = children_map.get(child.id)
             if _childs:
-                data["children"] = get_child_dept(_childs)
+                data["children"] = get_child_dept(_childs, children_map)
             children.append(data)
     return children
 
@@ -166,17 +183,19 @@ class DeptViewSet(CustomModelViewSet):
         user = request.user
         name = str(request.GET.get("name", '')).strip()
         if name == '':
-            deptResult = Dept.objects.filter(parent=None).order_by('sort')
+            deptResult = Dept.objects.filter(parent=None).select_related('parent').order_by('sort')
         else:
-            deptResult = Dept.objects.filter(name__icontains=name).order_by('sort')
+            deptResult = Dept.objects.filter(name__icontains=name).select_related('parent').order_by('sort')
+        deptResult = list(deptResult)
+        children_map = get_dept_children_map([dept.id for dept in deptResult])
         tree = []
         for dept in deptResult:
             menu_data = {"id": dept.id, "createTime": dept.create_datetime, "name": dept.name, "status": dept.status,
                          "sort": dept.sort, "parent": dept.parent.id if dept.parent else "",
                          "parentName": dept.parent.name if dept.parent else "", "owner": dept.owner}
-            childs = Dept.objects.filter(parent=dept).order_by('sort')
+            childs = children_map.get(dept.id)
             if childs:
-                menu_data["children"] = get_child_dept(childs)
+                menu_data["children"] = get_child_dept(childs, children_map)
             tree.append(menu_data)
         if len(tree) == 0:
             return SuccessResponse('您暂无登录系统权限', )
@@ -38,6 +38,11 @@ class DictionaryInitSerializer(CustomModelSerializer):
         return data
 
     def save(self, **kwargs):
+        # 初始化时逐条保存子字典, 合并为一次刷新
+        with dispatch.deferred_refresh():
+            return self._save(**kwargs)
+
+    def _save(self, **kwargs):
         instance = super().save(**kwargs)
         children = self.initial_data.get('children')
         # 菜单表
@@ -16,6 +16,7 @@ from django.conf import settings
 
 from core_base import dispatch
 from core_base.models import Users
+from core_base.utils.data_scope import AUTH_CLAIM, build_auth_claims, is_auth_claims_enabled
 from core_base.utils.json_response import ErrorResponse, DetailResponse
 from core_base.utils.request_util import save_login_log
 from core_base.utils.serializers import CustomModelSerializer
@@ -58,6 +59,14 @@ class LoginSerializer(TokenObtainPairSerializer):
 
     default_error_messages = {"no_active_account": _("账号/密码错误")}
 
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # 权限摘要, 权限版本号未变化时鉴权不再查询角色
+        if is_auth_claims_enabled():
+            token[AUTH_CLAIM] = build_auth_claims(user)
+        return token
+
     def validate(self, attrs):
         captcha = self.initial_data.get("verificationCode", None)
         if dispatch.get_system_config_values("base.captcha_state"):
@@ -84,7 +93,7 @@ class LoginSerializer(TokenObtainPairSerializer):
         data["userId"] = self.user.id
         request = self.context.get("request")
         request.user = self.user
-        # 记录登录日志
+        # 记录登录日志(LOGIN_LOG_ASYNC 为 True 时异步写入)
         save_login_log(request=request)
         return {"code": 200, "msg": "请求成功", "data": data}
 
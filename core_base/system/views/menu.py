@@ -6,6 +6,7 @@ from rest_framework.decorators import action
 from core_base.models import Menu, MenuButton, Role
 from core_base.system.views.MenuButton import MenuButtonSerializer
 from core_base.utils.json_response import SuccessResponse, ErrorResponse, DetailResponse
+from core_base.utils.menu_tree import get_menu_tree
 from core_base.utils.serializers import CustomModelSerializer
 from core_base.utils.viewset import CustomModelViewSet
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
@@ -149,31 +150,6 @@ class WebRouterSerializer(CustomModelSerializer):
         read_only_fields = ["id"]
 
 
-# 递归获取菜单
-def get_child_menu(childs, menuIds, treeIds, isAdmin=False):
-    '''
-    :param 当前节点:
-    :return [{"id": child.id, "title": child.title, "children": []}]:
-    '''
-    children = []
-    if childs:
-        for child in childs:
-            if child.id in menuIds and child.id not in treeIds:
-                menu_button_list = list(MenuButton.objects.filter(menu=child).values("id", "name", "value"))
-                data = {"id": child.id, "path": child.path, "name": child.name,
-                        "component": child.component, "meta": child.meta, 'label': child.meta.get('title', ''),
-                        "menu_button_list": menu_button_list}
-                treeIds.append(child.id)
-                if isAdmin:
-                    _childs = Menu.objects.filter(parent=child).order_by('sort')
-                else:
-                    _childs = Menu.objects.filter(parent=child, status=True).order_by('sort')
-                if _childs:
-                    data["children"] = get_child_menu(_childs, menuIds, treeIds, isAdmin)
-                children.append(data)
-    return children
-
-
 class MenuViewSet(CustomModelViewSet):
     """
     菜单管理接口
@@ -194,22 +170,8 @@ class MenuViewSet(CustomModelViewSet):
     # 返回左侧菜单
     @action(methods=['get'], detail=False, url_path='leftMenu', permission_classes=[])
     def leftMenu(self, request, *args, **kwargs):
-        # 获得用户权限
-        user = request.user
-        tree, treeIds, menusResult = [], [], []
-        menuIds = Menu.objects.values_list('id', flat=True) if user.is_superuser else user.role.values_list('menu__id', flat=True)
-        menusResult = Menu.objects.filter(id__in=menuIds, status=True, parent=None).order_by('sort')
-        for menu in menusResult:
-            if menu.id not in treeIds:
-                menu_button_list = list(MenuButton.objects.filter(menu=menu).values("id", "name", "value"))
-                menu_data = {"id": menu.id, "path": menu.path, "name": menu.name,
-                             "component": menu.component, "meta": menu.meta, "label": menu.meta.get('title', ''),
-                             "menu_button_list": menu_button_list}
-                treeIds.append(menu.id)
-                childs = Menu.objects.filter(parent=menu).order_by('sort')
-                if childs:
-                    menu_data["children"] = get_child_menu(childs, menuIds, treeIds)
-                tree.append(menu_data)
+        # 获得用户权限, 菜单树按角色集合缓存
+        tree = get_menu_tree(request.user)
         if len(tree) == 0:
             return ErrorResponse(code=-1, msg='您暂无登录系统权限', )
         return SuccessResponse(data=tree, total=len(tree))
@@ -217,23 +179,8 @@ class MenuViewSet(CustomModelViewSet):
     # 管理菜单
     @action(methods=['post'], detail=False, url_path='manageLeftMenu', permission_classes=[IsAdminUser])
     def manageLeftMenu(self, request, *args, **kwargs):
-        # 获得用户权限
-        user = request.user
-        tree, treeIds, menusResult = [], [], []
-        menuIds = Menu.objects.values_list('id', flat=True) if user.is_superuser else user.role.values_list('menu__id', flat=True)
-
-        menusResult = Menu.objects.filter(parent=None, id__in=menuIds, ).order_by('sort')
-        for menu in menusResult:
-            if menu.id not in treeIds:
-                menu_button_list = list(MenuButton.objects.filter(menu=menu).values("id", "name", "value"))
-                menu_data = {"id": menu.id, "path": menu.path, "name": menu.name,
-                             "component": menu.component, "meta": menu.meta, "label": menu.meta.get('title', ''),
-                             "menu_button_list": menu_button_list}
-                treeIds.append(menu.id)
-                childs = Menu.objects.filter(parent=menu).order_by('sort')
-                if childs:
-                    menu_data["children"] = get_child_menu(childs, menuIds, treeIds, True)
-                tree.append(menu_data)
+        # 获得用户权限, 菜单树按角色集合缓存
+        tree = get_menu_tree(request.user, is_admin=True)
         return SuccessResponse(data=tree, total=len(tree))
 
     @action(methods=['get'], detail=False, permission_classes=[])
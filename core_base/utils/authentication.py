@@ -1,10 +1,66 @@
+import copy
+
+from django.conf import settings
+from django.db import connection
 from rest_framework import exceptions
 from rest_framework.authentication import BaseAuthentication
 from django.contrib.auth import get_user_model
-from core_base import settings as config
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from core_base import settings as config, dispatch
+from core_base.utils.local_cache import LRUCache
 from jwt import decode as jwt_decode
 User = get_user_model()
 
+# 用户id => (用户字段值, 角色id)
+_user_snapshot_cache = LRUCache(
+    maxsize=getattr(settings, "USER_SNAPSHOT_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "USER_SNAPSHOT_CACHE_TTL", 5),
+)
+
+
+def _get_snapshot_key(user_id):
+    if dispatch.is_tenants_mode():
+        return connection.tenant.schema_name, str(user_id)
+    return None, str(user_id)
+
+
+def get_user_snapshot(user_id):
+    """
+    获取认证用户, USER_SNAPSHOT_CACHE 为 True 时使用进程内短时缓存, 每次返回新的用户实例
+    缓存内容为用户字段值及角色id, 用户保存/删除/角色变更时失效, 其它进程最长 USER_SNAPSHOT_CACHE_TTL 秒后失效
+    :param user_id: 用户id
+    :return: User
+    """
+    if not getattr(settings, "USER_SNAPSHOT_CACHE", False):
+        return User.objects.get(id=user_id)
+    key = _get_snapshot_key(user_id)
+    snapshot = _user_snapshot_cache.get(key)
+    if snapshot is None:
+        user = User.objects.get(id=user_id)
+        values = tuple(getattr(user, field.attname) for field in User._meta.concrete_fields)
+        role_ids = tuple(user.role.values_list("id", flat=True)) if hasattr(user, "role") else ()
+        snapshot = (values, role_ids)
+        _user_snapshot_cache.set(key, snapshot)
+    values, role_ids = snapshot
+    # JSONField 等可变字段值每次复制, 避免请求之间共享同一对象
+    user = User.from_db(User.objects.db, [field.attname for field in User._meta.concrete_fields], copy.deepcopy(list(values)))
+    user.snapshot_role_ids = role_ids
+    return user
+
+
+def invalidate_user_snapshot(user_id=None):
+    """
+    使用户缓存失效
+    :param user_id: 用户id, None 时清空全部
+    :return:
+    """
+    if user_id is None:
+        _user_snapshot_cache.clear()
+    else:
+        _user_snapshot_cache.delete(_get_snapshot_key(user_id))
+
+
 class UserAuthentication(BaseAuthentication):
     '''
     支持GET 参数传入token 为了解决导出excel身份认证问题
@@ -14,10 +70,32 @@ class UserAuthentication(BaseAuthentication):
         try:
             decoded_data = jwt_decode(access_token, config.SECRET_KEY, algorithms=["HS256"])
             userid = decoded_data["user_id"]
-            currentUser = User.objects.get(id=int(userid))
+            currentUser = get_user_snapshot(int(userid))
             return currentUser, access_token
         except Exception as ex:
             raise exceptions.AuthenticationFailed(detail={'code': 401, 'msg': 'access_token已过期'})
 
     def authenticate_header(self, request):
         pass
+
+
+class CustomJWTAuthentication(JWTAuthentication):
+    '''
+    JWT 认证, 用户通过 get_user_snapshot 获取, 开启 USER_SNAPSHOT_CACHE 后高频请求不再查询用户表
+    '''
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise exceptions.AuthenticationFailed("Token contained no recognizable user identification")
+        try:
+            # 用户缓存按主键保存及失效, USER_ID_FIELD 不是 id 时直接查询
+            if jwt_settings.USER_ID_FIELD == "id":
+                user = get_user_snapshot(user_id)
+            else:
+                user = User.objects.get(**{jwt_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise exceptions.AuthenticationFailed("User not found")
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed("User is inactive")
+        return user
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+跨进程缓存版本号
+(1)版本号保存在 django cache 中, 多个 worker/节点共享同一份版本号
+(2)每个进程本地记录最近一次读取到的版本号, 在 CACHE_VERSION_CHECK_INTERVAL 秒内不重复读取 cache
+(3)数据有变更时调用 bump_version 递增版本号, 各进程在下一次检查时发现版本变化后自行重建本地缓存
+(4)CACHE_VERSION_ALIAS 必须为 redis/memcached/数据库等多进程共享的 cache, LocMemCache/DummyCache 只在单进程内有效
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+
+from core_base import dispatch
+
+logger = logging.getLogger(__name__)
+
+# 只在当前进程内有效的 cache 后端
+LOCAL_CACHE_BACKENDS = (LocMemCache, DummyCache)
+
+_local_versions = {}
+_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """
+    获取保存版本号及跨进程共享数据的 cache
+    :return:
+    """
+    return caches[getattr(settings, "CACHE_VERSION_ALIAS", "default")]
+
+
+def is_shared_cache():
+    """
+    版本号所用的 cache 是否在多进程间共享
+    :return:
+    """
+    return not isinstance(get_shared_cache(), LOCAL_CACHE_BACKENDS)
+
+
+def check_shared_cache():
+    """
+    启动时检查版本号所用的 cache, 非共享 cache 时多 worker 之间的缓存失效不生效
+    :return:
+    """
+    if not is_shared_cache():
+        logger.warning(
+            "CACHE_VERSION_ALIAS=%s 为进程内 cache(%s), 多 worker/多节点部署时缓存不会跨进程失效, 请配置 redis 等共享缓存",
+            getattr(settings, "CACHE_VERSION_ALIAS", "default"), type(get_shared_cache()).__name__,
+        )
+
+
+def _get_cache_key(name):
+    """
+    获取版本号的 cache key, 租户模式下按 schema_name 区分
+    :param name: 版本名称
+    :return:
+    """
+    if dispatch.is_tenants_mode():
+        return f"core_base:version:{connection.tenant.schema_name}:{name}"
+    return f"core_base:version:{name}"
+
+
+def _new_version():
+    # 使用纳秒时间戳作为初始值, 避免 cache 被清空后版本号回退到旧值
+    return time.time_ns()
+
+
+def get_model_version_name(model):
+    """
+    模型写入版本号名称, 模型数据新增/修改/删除后递增
+    :param model: 模型类
+    :return:
+    """
+    return f"model:{model._meta.label_lower}"
+
+
+def get_version(name):
+    """
+    获取当前版本号
+    :param name: 版本名称
+    :return: int
+    """
+    key = _get_cache_key(name)
+    now = time.monotonic()
+    interval = getattr(settings, "CACHE_VERSION_CHECK_INTERVAL", 1)
+    local = _local_versions.get(key)
+    if local and now - local[1] < interval:
+        return local[0]
+    cache = get_shared_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key) or _new_version()
+    with _lock:
+        _local_versions[key] = (version, now)
+    return version
+
+
+def _bump_keys(keys):
+    cache = get_shared_cache()
+    for key in keys:
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            version = _new_version()
+            cache.set(key, version, None)
+        with _lock:
+            _local_versions[key] = (version, time.monotonic())
+
+
+def bump_version(*names):
+    """
+    递增版本号, 使所有进程中对应的本地缓存失效
+    :param names: 版本名称
+    :return:
+    """
+    _bump_keys([_get_cache_key(name) for name in names])
+
+
+def bump_version_on_commit(*names):
+    """
+    事务提交后再递增版本号, 避免其它进程读取到未提交的数据并缓存
+    cache key 在调用时确定, 保证租户模式下递增的是当前 schema 的版本号
+    :param names: 版本名称
+    :return:
+    """
+    keys = [_get_cache_key(name) for name in names]
+    transaction.on_commit(lambda: _bump_keys(keys))
+
+
+class VersionedCache:
+    """
+    进程内 LRU 缓存, 对应版本号变化时整体失效
+    (1)租户模式下每个 schema 独立缓存
+    (2)maxsize 限制每个 schema 缓存的最大条数
+    """
+
+    def __init__(self, name, maxsize=1024):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _get_bucket(self):
+        schema_name = connection.tenant.schema_name if dispatch.is_tenants_mode() else None
+        version = get_version(self.name)
+        bucket = self._data.get(schema_name)
+        if bucket is None or bucket[0] != version:
+            bucket = (version, OrderedDict())
+            with self._lock:
+                self._data[schema_name] = bucket
+        return bucket[1]
+
+    def get(self, key, default=None):
+        items = self._get_bucket()
+        with self._lock:
+            if key not in items:
+                return default
+            items.move_to_end(key)
+            return items[key]
+
+    def set(self, key, value, items=None):
+        items = self._get_bucket() if items is None else items
+        with self._lock:
+            items[key] = value
+            items.move_to_end(key)
+            while len(items) > self.maxsize:
+                items.popitem(last=False)
+
+    def get_or_set(self, key, builder):
+        """
+        获取缓存, 不存在时调用 builder 生成并缓存
+        :param key: 缓存键
+        :param builder: 无参函数, 返回需要缓存的值
+        :return:
+        """
+        items = self._get_bucket()
+        with self._lock:
+            if key in items:
+                items.move_to_end(key)
+                return items[key]
+        value = builder()
+        # 写入构建前取得的 bucket, 构建期间版本变化时旧结果随旧 bucket 一起丢弃
+        self.set(key, value, items)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+用户数据权限范围
+(1)根据用户的角色解析出最终的数据权限范围: 全部数据、仅本人数据、部门id集合
+(2)解析结果缓存在进程内及共享 cache 中, 按用户id、用户部门及权限版本号区分
+(3)角色、角色部门、用户角色、部门变更时递增权限版本号, 用户部门变更时缓存键随之变化
+(4)开启 AUTH_CLAIMS 时登录将权限摘要写入令牌, 版本号未变化时鉴权直接使用令牌中的角色及数据权限范围
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from core_base import dispatch
+from core_base.models import Dept, DeptClosure
+from core_base.utils.cache_version import VersionedCache, get_shared_cache, get_version, is_shared_cache
+
+# 角色/角色部门/用户角色/部门变更时递增的版本号名称
+AUTH_VERSION = "auth"
+# 令牌中权限摘要的字段名
+AUTH_CLAIM = "auth"
+
+SCOPE_ALL = "all"
+SCOPE_SELF = "self"
+SCOPE_DEPT = "dept"
+SCOPE_NONE = "none"
+
+# kind: 权限类型; dept_ids: 可见部门id集合, 部门过多时为 None; data_ranges: 角色的数据权限范围集合
+DataScope = namedtuple("DataScope", ["kind", "dept_ids", "data_ranges"])
+
+_data_scope_cache = VersionedCache(AUTH_VERSION, maxsize=10000)
+
+
+def get_user_data_ranges(user):
+    """
+    获取用户启用角色的数据权限范围, 管理员角色视为全部数据权限(3)
+    :param user:
+    :return: frozenset
+    """
+    data_ranges = set()
+    for role in user.role.filter(status=1).values("admin", "data_range"):
+        data_ranges.add(3 if role.get("admin") == True else role.get("data_range"))
+    return frozenset(data_ranges)
+
+
+def resolve_data_scope(user, data_ranges=None):
+    """
+    根据用户角色解析数据权限范围
+    (0, "仅本人数据权限"), (1, "本部门及以下数据权限"), (2, "本部门数据权限"), (3, "全部数据权限"), (4, "自定数据权限")
+    :param user: 非超级管理员且有部门的用户
+    :param data_ranges: 角色的数据权限范围集合, 为 None 时从数据库查询
+    :return: DataScope
+    """
+    data_ranges = get_user_data_ranges(user) if data_ranges is None else frozenset(data_ranges)
+    # 判断用户是否为超级管理员角色/如果拥有[全部数据权限]则返回所有数据
+    if 3 in data_ranges:
+        return DataScope(SCOPE_ALL, None, frozenset())
+    if 0 in data_ranges:
+        return DataScope(SCOPE_SELF, None, data_ranges)
+    conditions = []
+    if 1 in data_ranges or 2 in data_ranges:
+        conditions.append(Q(id=user.dept_id))
+    if 1 in data_ranges:
+        conditions.append(Q(id__in=DeptClosure.objects.descendants_of(user.dept_id).values("descendant_id")))
+    if 4 in data_ranges:
+        conditions.append(Q(id__in=user.role.filter(status=1).values("dept__id")))
+    if not conditions:
+        return DataScope(SCOPE_NONE, None, data_ranges)
+    limit = getattr(settings, "DATA_SCOPE_INLINE_LIMIT", 500)
+    query = conditions[0]
+    for condition in conditions[1:]:
+        query |= condition
+    dept_ids = list(Dept.objects.filter(query).values_list("id", flat=True)[:limit + 1])
+    if len(dept_ids) > limit:
+        return DataScope(SCOPE_DEPT, None, data_ranges)
+    return DataScope(SCOPE_DEPT, frozenset(dept_ids), data_ranges)
+
+
+def get_data_scope(user, data_ranges=None):
+    """
+    获取用户的数据权限范围, 依次读取进程内缓存、共享 cache, 都没有时解析并缓存
+    :param user: 非超级管理员且有部门的用户
+    :param data_ranges: 令牌中的数据权限范围集合, 为 None 时从数据库查询
+    :return: DataScope
+    """
+    key = (user.id, user.dept_id)
+    scope = _data_scope_cache.get(key)
+    if scope is not None:
+        return scope
+    schema_name = f"{connection.tenant.schema_name}:" if dispatch.is_tenants_mode() else ""
+    shared_key = f"core_base:data_scope:{schema_name}{get_version(AUTH_VERSION)}:{user.id}:{user.dept_id}"
+    cache = get_shared_cache()
+    scope = cache.get(shared_key)
+    if scope is None:
+        scope = resolve_data_scope(user, data_ranges)
+        cache.set(shared_key, scope, getattr(settings, "DATA_SCOPE_CACHE_TTL", 3600))
+    _data_scope_cache.set(key, scope)
+    return scope
+
+
+def build_auth_claims(user):
+    """
+    生成写入令牌的权限摘要
+    :param user:
+    :return: {"role_ids": 角色id, "data_ranges": 数据权限范围, "dept_id": 部门id, "version": 权限版本号}
+    """
+    return {
+        "role_ids": sorted(user.role.values_list("id", flat=True)),
+        "data_ranges": sorted(get_user_data_ranges(user)),
+        "dept_id": user.dept_id,
+        "version": get_version(AUTH_VERSION),
+    }
+
+
+def is_auth_claims_enabled():
+    """
+    是否使用令牌中的权限摘要, 需开启 AUTH_CLAIMS 且版本号保存在共享 cache 中
+    进程内 cache 无法感知其它进程的权限变更, 此时不信任令牌中的权限摘要
+    :return:
+    """
+    return getattr(settings, "AUTH_CLAIMS", False) and is_shared_cache()
+
+
+def get_auth_claims(request):
+    """
+    获取令牌中的权限摘要, 未启用、权限版本号或用户部门已变化时返回 None, 由调用方从数据库查询
+    :param request: DRF request
+    :return: dict or None
+    """
+    if not is_auth_claims_enabled():
+        return None
+    token = getattr(request, "auth", None)
+    if not hasattr(token, "get"):
+        return None
+    claims = token.get(AUTH_CLAIM)
+    if not isinstance(claims, dict):
+        return None
+    if claims.get("version") != get_version(AUTH_VERSION) or claims.get("dept_id") != getattr(request.user, "dept_id", None):
+        return None
+    return claims
@@ -1,14 +1,18 @@
 # -*- coding: UTF-8 -*-
 # ! /usr/bin/env python
 import base64
+from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Cipher import PKCS1_v1_5 as PKCS1_v1_5_cipper
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA
+from Crypto.Random import get_random_bytes
 
 import Crypto
 import os, uuid, time, io, re, zipfile,json
+import threading
 from core_base import settings as config
+from core_base.utils.local_cache import LRUCache
 import configparser
 
 
@@ -133,6 +137,79 @@ class RsaUtil(object):
 
         return cipher.verify(hs, signature)
 
+class EnvelopeUtil(object):
+    """
+    信封加密: 使用 AES-GCM 数据密钥加密内容, 数据密钥经 RSA 公钥加密后随密文保存
+    密文格式: v2$<base64(RSA加密的数据密钥)>$<base64(nonce + tag + 密文)>
+    (1)进程内生成数据密钥并缓存, 加密时不再进行 RSA 运算
+    (2)解密后的数据密钥按加密后的数据密钥缓存, 同一数据密钥在每个进程只进行一次 RSA 私钥解密
+    """
+    VERSION_PREFIX = "v2$"
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    # 单个数据密钥最多加密的次数, 超过后重新生成数据密钥
+    MAX_MESSAGES = 2 ** 30
+
+    def __init__(self, rsa_util, key_cache_size=1024):
+        self.rsa_util = rsa_util
+        self._data_key = None
+        self._wrapped_key = None
+        self._messages = 0
+        self._lock = threading.Lock()
+        self._key_cache = LRUCache(maxsize=key_cache_size)
+
+    def _get_data_key(self):
+        with self._lock:
+            if self._data_key is None or self._messages >= self.MAX_MESSAGES:
+                data_key = get_random_bytes(32)
+                wrapped_key = PKCS1_OAEP.new(self.rsa_util.company_public_key).encrypt(data_key)
+                self._data_key = data_key
+                self._wrapped_key = base64.b64encode(wrapped_key).decode()
+                self._messages = 0
+                self._key_cache.set(self._wrapped_key, data_key)
+            self._messages += 1
+            return self._data_key, self._wrapped_key
+
+    def _unwrap_key(self, wrapped_key):
+        data_key = self._key_cache.get(wrapped_key)
+        if data_key is None:
+            data_key = PKCS1_OAEP.new(self.rsa_util.company_private_key).decrypt(base64.b64decode(wrapped_key))
+            self._key_cache.set(wrapped_key, data_key)
+        return data_key
+
+    @classmethod
+    def is_envelope(cls, message):
+        """
+        是否为信封加密的密文
+        """
+        return isinstance(message, str) and message.startswith(cls.VERSION_PREFIX)
+
+    def encrypt(self, encrypt_message):
+        """加密.
+            :param encrypt_message: 需要加密的字符串.
+            :return: 带版本头的密文字符串
+        """
+        data_key, wrapped_key = self._get_data_key()
+        nonce = get_random_bytes(self.NONCE_SIZE)
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(encrypt_message.encode(encoding='utf-8'))
+        payload = base64.b64encode(nonce + tag + ciphertext).decode()
+        return f"{self.VERSION_PREFIX}{wrapped_key}${payload}"
+
+    def decrypt(self, decrypt_message):
+        """解密.
+            :param decrypt_message: encrypt 返回的密文.
+            :return: 解密后的字符串
+        """
+        wrapped_key, payload = decrypt_message[len(self.VERSION_PREFIX):].split("$", 1)
+        payload = base64.b64decode(payload)
+        nonce = payload[:self.NONCE_SIZE]
+        tag = payload[self.NONCE_SIZE:self.NONCE_SIZE + self.TAG_SIZE]
+        ciphertext = payload[self.NONCE_SIZE + self.TAG_SIZE:]
+        cipher = AES.new(self._unwrap_key(wrapped_key), AES.MODE_GCM, nonce=nonce)
+        return cipher.decrypt_and_verify(ciphertext, tag).decode(encoding='utf-8')
+
+
 if __name__ == "__main__":
     #message = 'hellworldhellworldhellworldhellhellworldhellworldhellwo'
     message = json.dumps({"mac":"mac-mac","hostname":"hname","ip":"127.0.0.1"})
@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import operator
-import re
 from collections import OrderedDict
 from functools import reduce
 
 import six
-from django.db.models import Q, F
+from django.db.models import Q, CharField
+from django.db.models.functions import Cast
 from django.db.models.constants import LOOKUP_SEP
 from django_filters import utils
 from django_filters.filters import CharFilter
@@ -14,26 +14,21 @@ from django_filters.rest_framework import DjangoFilterBackend
 from django_filters.utils import get_model_field
 from rest_framework.filters import BaseFilterBackend
 
-from core_base.models import Dept, ApiWhiteList
+from core_base.models import Dept, DeptClosure, EncrypyField
+from core_base.utils.permission import METHOD_LIST, get_api_white_list
+from core_base.utils.validator import CustomValidationError
+from core_base.utils.data_scope import get_auth_claims, get_data_scope, SCOPE_ALL, SCOPE_SELF, SCOPE_NONE
 
 
 def get_dept(dept_id: int, dept_all_list=None, dept_list=None):
     """
-    递归获取部门的所有下级部门
+    获取部门及其所有下级部门id
+    基于部门闭包表一次查询完成, dept_all_list/dept_list 参数仅为兼容旧调用保留
     :param dept_id: 需要获取的部门id
-    :param dept_all_list: 所有部门列表
-    :param dept_list: 递归部门list
     :return:
     """
-    if not dept_all_list:
-        dept_all_list = Dept.objects.all().values("id", "parent")
-    if dept_list is None:
-        dept_list = [dept_id]
-    for ele in dept_all_list:
-        if ele.get("parent") == dept_id:
-            dept_list.append(ele.get("id"))
-            get_dept(ele.get("id"), dept_all_list, dept_list)
-    return list(set(dept_list))
+    dept_ids = Dept.objects.descendants(dept_id).values_list("id", flat=True)
+    return list({dept_id, *dept_ids})
 
 
 class DataLevelPermissionsFilter(BaseFilterBackend):
@@ -49,32 +44,50 @@ class DataLevelPermissionsFilter(BaseFilterBackend):
     5. 自定数据权限 获取部门，根据部门过滤
     """
 
+    def get_dept_scope_query(self, user, user_dept_id, data_scope_list, is_dept_model=False):
+        """
+        根据数据权限范围构建部门过滤条件, 部门范围以子查询形式下推到数据库, 不在 Python 中展开部门id列表
+        1 本部门及以下: 部门闭包表子查询
+        2 本部门: 当前用户部门
+        4 自定数据权限: 角色关联部门子查询
+        :param user: 当前用户
+        :param user_dept_id: 当前用户部门id
+        :param data_scope_list: 数据权限范围列表
+        :param is_dept_model: 是否为部门表, 部门表按 id 过滤, 其它表按 dept_belong_id 过滤
+        :return: Q, 没有可见部门时返回 None
+        """
+        field_name = "id" if is_dept_model else "dept_belong_id"
+
+        def dept_subquery(queryset, column):
+            if is_dept_model:
+                return queryset.values(column)
+            # dept_belong_id 为字符串字段, 子查询结果转换为字符串后比较
+            return queryset.annotate(scope_dept_id=Cast(column, CharField())).values("scope_dept_id")
+
+        conditions = []
+        if 1 in data_scope_list or 2 in data_scope_list:
+            conditions.append(Q(**{field_name: user_dept_id}))
+        if 1 in data_scope_list:
+            conditions.append(Q(**{f"{field_name}__in": dept_subquery(
+                DeptClosure.objects.descendants_of(user_dept_id), "descendant_id"
+            )}))
+        if 4 in data_scope_list:
+            conditions.append(Q(**{f"{field_name}__in": dept_subquery(
+                user.role.filter(status=1, dept__isnull=False), "dept__id"
+            )}))
+        if not conditions:
+            return None
+        return reduce(operator.or_, conditions)
+
     def filter_queryset(self, request, queryset, view):
         """
         接口白名单是否认证数据权限
         """
         api = request.path  # 当前请求接口
         method = request.method  # 当前请求方法
-        methodList = ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
-        method = methodList.index(method)
         # ***接口白名单***
-        api_white_list = ApiWhiteList.objects.filter(enable_datasource=False).values(
-            permission__api=F("url"), permission__method=F("method")
-        )
-        api_white_list = [
-            str(item.get("permission__api").replace("{id}", ".*?"))
-            + ":"
-            + str(item.get("permission__method"))
-            for item in api_white_list
-            if item.get("permission__api")
-        ]
-        for item in api_white_list:
-            new_api = api + ":" + str(method)
-            matchObj = re.match(item, new_api, re.M | re.I)
-            if matchObj is None:
-                continue
-            else:
-                return queryset
+        if method in METHOD_LIST and get_api_white_list(enable_datasource=False).match(api, METHOD_LIST.index(method)):
+            return queryset
         """
         判断是否为超级管理员:
         如果不是超级管理员,则进入下一步权限判断
@@ -93,48 +106,37 @@ class DataLevelPermissionsFilter(BaseFilterBackend):
             if not hasattr(request.user, "role"):
                 return queryset.filter(dept_belong_id=user_dept_id)
 
-            # 3. 根据所有角色 获取所有权限范围
+            # 3. 根据所有角色 获取所有权限范围(按用户缓存)
             # (0, "仅本人数据权限"),
             # (1, "本部门及以下数据权限"),
             # (2, "本部门数据权限"),
             # (3, "全部数据权限"),
             # (4, "自定数据权限")
-            role_list = request.user.role.filter(status=1).values("admin", "data_range")
-            dataScope_list = []  # 权限范围列表
-            for ele in role_list:
-                # 判断用户是否为超级管理员角色/如果拥有[全部数据权限]则返回所有数据
-                if 3 == ele.get("data_range") or ele.get("admin") == True:
-                    return queryset
-                dataScope_list.append(ele.get("data_range"))
-            dataScope_list = list(set(dataScope_list))
+            claims = get_auth_claims(request)
+            data_scope = get_data_scope(request.user, claims["data_ranges"] if claims else None)
+            if data_scope.kind == SCOPE_ALL:
+                return queryset
 
             # 4. 只为仅本人数据权限时只返回过滤本人数据，并且部门为自己本部门(考虑到用户会变部门，只能看当前用户所在的部门数据)
-            if 0 in dataScope_list:
+            if data_scope.kind == SCOPE_SELF:
                 return queryset.filter(
                     creator=request.user, dept_belong_id=user_dept_id
                 )
+            if data_scope.kind == SCOPE_NONE:
+                return queryset.none()
 
             # 5. 自定数据权限 获取部门，根据部门过滤
-            dept_list = []
-            for ele in dataScope_list:
-                if ele == 4:
-                    dept_list.extend(
-                        request.user.role.filter(status=1).values_list(
-                            "dept__id", flat=True
-                        )
-                    )
-                elif ele == 2:
-                    dept_list.append(user_dept_id)
-                elif ele == 1:
-                    dept_list.append(user_dept_id)
-                    dept_list.extend(
-                        get_dept(
-                            user_dept_id,
-                        )
-                    )
-            if queryset.model._meta.model_name == 'dept':
-                return queryset.filter(id__in=list(set(dept_list)))
-            return queryset.filter(dept_belong_id__in=list(set(dept_list)))
+            is_dept_model = queryset.model._meta.model_name == 'dept'
+            if data_scope.dept_ids is not None:
+                field_name = "id" if is_dept_model else "dept_belong_id"
+                return queryset.filter(**{f"{field_name}__in": data_scope.dept_ids})
+            # 部门数量较多时使用子查询过滤
+            dept_scope = self.get_dept_scope_query(
+                request.user, user_dept_id, data_scope.data_ranges, is_dept_model
+            )
+            if dept_scope is None:
+                return queryset.none()
+            return queryset.filter(dept_scope)
         else:
             return queryset
 
@@ -278,22 +280,33 @@ class CustomDjangoFilterBackend(DjangoFilterBackend):
             return queryset
         if filterset.__class__.__name__ == "AutoFilterSet":
             queryset = filterset.queryset
+            is_list_fields = isinstance(filterset.__class__._meta.fields, (list, tuple))
             orm_lookups = []
+            encrypted_fields = set()
             for search_field in filterset.filters:
-                if isinstance(filterset.filters[search_field], CharFilter):
+                field_name = filterset.filters[search_field].field_name
+                model_field = get_model_field(queryset.model, field_name)
+                # 加密字段只支持盲索引等值查询, Meta.fields 为 dict/__all__ 时同样处理
+                if isinstance(model_field, EncrypyField):
+                    blind_lookup = LOOKUP_SEP.join([field_name, "blind_exact"])
+                    if not model_field.blind_index:
+                        encrypted_fields.add(field_name)
+                    elif blind_lookup not in orm_lookups:
+                        orm_lookups.append(blind_lookup)
+                elif not is_list_fields:
+                    orm_lookups.append(search_field)
+                elif isinstance(filterset.filters[search_field], CharFilter):
                     orm_lookups.append(
                         self.construct_search(six.text_type(search_field))
                     )
                 else:
                     orm_lookups.append(search_field)
-            orm_lookups = (
-                orm_lookups
-                if isinstance(filterset.__class__._meta.fields, (list, tuple))
-                else filterset.filters.keys()
-            )
             conditions = []
             queries = []
             for search_term_key in filterset.data.keys():
+                # 未开启盲索引的加密字段无法查询, 直接报错避免忽略条件后返回未过滤的数据
+                if search_term_key.split(LOOKUP_SEP)[0] in encrypted_fields:
+                    raise CustomValidationError(f"字段{search_term_key}为加密字段, 不支持查询")
                 orm_lookup = self.find_filter_lookups(orm_lookups, search_term_key)
                 if not orm_lookup:
                     continue
@@ -1,19 +1,49 @@
 # -*- coding: utf-8 -*-
+import operator
+import tempfile
+import warnings
+from functools import reduce
+from itertools import chain, islice
 from urllib.parse import quote
 
-from django.db import transaction
-from django.http import HttpResponse
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction, router, connections
+from django.db.models import Q
+from django.http import HttpResponse, FileResponse
+from django.utils import timezone
 from openpyxl import Workbook
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.utils import get_column_letter, quote_sheetname
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.request import Request
+from rest_framework.serializers import BaseSerializer, ModelSerializer
+from rest_framework.validators import UniqueValidator
 
+from core_base.models import BlindIndexField, EncrypyField
+from core_base.signals import refresh_bulk_write
 from core_base.utils.import_export import import_to_data
 from core_base.utils.json_response import DetailResponse
+from core_base.utils.serializers import CustomModelSerializer
 from core_base.utils.request_util import get_verbose_name
 
 
+class PreloadedQuerySet:
+    """
+    批量导入时预先查询的关联数据, 替换主键关联字段的 queryset, 逐行校验时不再查询数据库
+    """
+
+    def __init__(self, model, objs):
+        self.model = model
+        self.objs = {str(pk): obj for pk, obj in objs.items()}
+
+    def get(self, pk=None):
+        obj = self.objs.get(str(pk))
+        if obj is None:
+            raise self.model.DoesNotExist
+        return obj
+
+
 class ImportSerializerMixin:
     """
     自定义导入模板、导入功能
@@ -23,6 +53,11 @@ class ImportSerializerMixin:
     import_field_dict = {}
     # 导入序列化器
     import_serializer_class = None
+    # 是否批量导入, 批量写入不会调用模型的 save 方法及信号, 依赖 save 逻辑的模型请勿开启
+    # 导入序列化器自定义了 save/create/update 时仍逐行保存, 只批量进行校验查询
+    import_bulk = False
+    # 批量导入时每批处理的行数
+    import_chunk_size = 500
     # 表格表头最大宽度，默认50个字符
     export_column_width = 50
 
@@ -39,7 +74,6 @@ class ImportSerializerMixin:
             length += 2.1 if ord(char) > 256 else 1
         return round(length, 1) if length <= self.export_column_width else self.export_column_width
 
-    @transaction.atomic  # Django 事务,防止出错
     def import_data(self, request: Request, *args, **kwargs):
         """
         导入模板
@@ -130,19 +164,314 @@ class ImportSerializerMixin:
         unique_list = [
             ele.attname for ele in queryset.model._meta.get_fields() if hasattr(ele, "unique") and ele.unique == True
         ]
-        for ele in data:
-            # 获取 unique 字段
-            filter_dic = {i: ele.get(i) for i in list(set(self.import_field_dict.keys()) & set(unique_list))}
-            instance = filter_dic and queryset.filter(**filter_dic).first()
-            if instance and not updateSupport:
-                continue
-            if not filter_dic:
-                instance = None
-            serializer = self.import_serializer_class(instance, data=ele)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+        unique_fields = sorted(set(self.import_field_dict.keys()) & set(unique_list))
+        if self.import_bulk:
+            result = self.bulk_import(queryset, data, unique_fields, updateSupport, request)
+            if result["errors"]:
+                return DetailResponse(data=result, msg=f"导入完成, {len(result['errors'])}条数据导入失败！")
+            return DetailResponse(data=result, msg=f"导入成功！")
+        with transaction.atomic():  # Django 事务,防止出错
+            for ele in data:
+                # 获取 unique 字段
+                filter_dic = {i: ele.get(i) for i in unique_fields}
+                instance = filter_dic and queryset.filter(**filter_dic).first()
+                if instance and not updateSupport:
+                    continue
+                if not filter_dic:
+                    instance = None
+                serializer = self.import_serializer_class(instance, data=ele)
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
         return DetailResponse(msg=f"导入成功！")
 
+    def get_import_key(self, data, unique_fields):
+        """
+        获取数据的唯一标识, 唯一字段有空值时返回 None
+        """
+        if not unique_fields:
+            return None
+        key = tuple(data.get(field) for field in unique_fields)
+        if None in key:
+            return None
+        return tuple(str(ele) for ele in key)
+
+    def get_import_existing(self, queryset, chunk, unique_fields):
+        """
+        一次 IN 查询获取本批数据中已存在的数据
+        :return: {唯一标识: instance}
+        """
+        keys = {self.get_import_key(ele, unique_fields) for ele in chunk}
+        keys.discard(None)
+        if not keys:
+            return {}
+        if len(unique_fields) == 1:
+            condition = Q(**{f"{unique_fields[0]}__in": [key[0] for key in keys]})
+        else:
+            condition = reduce(operator.or_, [Q(**dict(zip(unique_fields, key))) for key in keys])
+        return {
+            tuple(str(getattr(instance, field)) for field in unique_fields): instance
+            for instance in queryset.filter(condition)
+        }
+
+    def bulk_import(self, queryset, data, unique_fields, update_support, request=None):
+        """
+        批量导入(import_bulk = True 时使用)
+        (1)每批数据通过一次 IN 查询匹配已存在的数据, 唯一字段及主键关联字段每批预先查询一次, 逐行校验时不再查询数据库
+        (2)逐行校验, 校验失败的行记录到错误报告中, 不中断导入
+        (3)使用 bulk_create/bulk_update 写入模型字段, 多对多字段直接批量写入中间表, 每批一个事务
+        (4)导入序列化器自定义了 save/create/update 时逐行调用 serializer.save(), 保留密码加密等保存逻辑
+        注意: 批量写入不会调用模型的 save 方法及 post_save 等信号, 写入后统一刷新信号对应的缓存版本号
+        :param queryset:
+        :param data: import_to_data 读取的数据
+        :param unique_fields: 用于匹配已存在数据的唯一字段
+        :param update_support: 已存在的数据是否更新
+        :param request: 当前请求, 用于写入创建人/修改人/数据归属部门
+        :return: {"created": 新增数, "updated": 更新数, "skipped": 跳过数, "errors": [{"row": excel行号, "errors": 错误信息}]}
+        """
+        result = {"created": 0, "updated": 0, "skipped": 0, "errors": []}
+        context = {"request": request} if request is not None else {}
+        for start in range(0, len(data), self.import_chunk_size):
+            self.bulk_import_chunk(
+                queryset, data[start:start + self.import_chunk_size], start, unique_fields, update_support, result,
+                context,
+            )
+        return result
+
+    def is_import_serializer_bulk(self):
+        """
+        导入序列化器是否可以批量写入, 自定义了 save/create/update 时需逐行调用 serializer.save()
+        :return:
+        """
+        serializer_class = self.import_serializer_class
+        return (
+            serializer_class.save in (BaseSerializer.save, CustomModelSerializer.save)
+            and serializer_class.create in (ModelSerializer.create, CustomModelSerializer.create)
+            and serializer_class.update in (ModelSerializer.update, CustomModelSerializer.update)
+        )
+
+    def get_import_preload(self, chunk, context):
+        """
+        预先查询本批数据的唯一字段已存在值及主键关联数据
+        :return: {"unique": [(字段名, UniqueValidator, {str(值): 主键})], "related": {字段名: PreloadedQuerySet}}
+        """
+        preload = {"unique": [], "related": {}}
+        fields = self.import_serializer_class(context=context).fields
+        for name, field in fields.items():
+            if field.read_only:
+                continue
+            values = [ele.get(name) for ele in chunk if ele.get(name) not in (None, "")]
+            if not values:
+                continue
+            relation = getattr(field, "child_relation", field)
+            if isinstance(relation, PrimaryKeyRelatedField) and relation.pk_field is None:
+                pks = set()
+                for value in values:
+                    pks.update(value if isinstance(value, (list, tuple)) else [value])
+                related_queryset = relation.get_queryset()
+                preload["related"][name] = PreloadedQuerySet(
+                    related_queryset.model, related_queryset.in_bulk(self.get_import_pks(related_queryset.model, pks))
+                )
+            for validator in field.validators:
+                if not isinstance(validator, UniqueValidator) or validator.lookup != "exact":
+                    continue
+                source = field.source_attrs[-1]
+                try:
+                    existing = {
+                        str(value): pk
+                        for value, pk in validator.queryset.filter(**{f"{source}__in": values}).values_list(source, "pk")
+                    }
+                except (TypeError, ValueError, DjangoValidationError):
+                    # 无法批量查询时保留逐行校验
+                    continue
+                preload["unique"].append((name, validator, existing))
+        return preload
+
+    def get_import_pks(self, model, values):
+        """
+        过滤无法转换为主键类型的值, 由关联字段校验报错
+        """
+        pks = []
+        for value in values:
+            try:
+                pks.append(model._meta.pk.to_python(value))
+            except DjangoValidationError:
+                continue
+        return pks
+
+    def apply_import_preload(self, serializer, preload):
+        """
+        使用预先查询的数据替换关联字段的 queryset, 并移除已预先查询的唯一校验
+        """
+        fields = serializer.fields
+        for name, related_queryset in preload["related"].items():
+            relation = getattr(fields[name], "child_relation", fields[name])
+            relation.queryset = related_queryset
+        for name, validator, existing in preload["unique"]:
+            fields[name].validators = [
+                ele for ele in fields[name].validators
+                if not (isinstance(ele, UniqueValidator) and ele.lookup == "exact")
+            ]
+
+    def check_import_unique(self, serializer, instance, preload, seen, row):
+        """
+        使用预先查询的数据校验唯一字段, 同一批数据内的重复值同样报错
+        :return: 错误信息, 无错误时返回 None
+        """
+        errors = {}
+        for name, validator, existing in preload["unique"]:
+            value = serializer.validated_data.get(serializer.fields[name].source_attrs[-1])
+            if value is None:
+                continue
+            key = str(value)
+            pk = existing.get(key)
+            if pk is not None and (instance is None or pk != instance.pk):
+                errors[name] = [validator.message]
+            elif key in seen.setdefault(name, {}):
+                errors[name] = [f"与第{seen[name][key]}行数据重复"]
+            else:
+                seen[name][key] = row
+        return errors or None
+
+    def get_import_audit_data(self, serializer, validated_data, instance):
+        """
+        与 CustomModelSerializer.create/update 一致的审计字段
+        """
+        if not isinstance(serializer, CustomModelSerializer):
+            return {}
+        audit_data = serializer.get_audit_data(validated_data, created=instance is None)
+        if instance is not None and serializer.request and hasattr(instance, serializer.modifier_field_id):
+            audit_data[serializer.modifier_field_id] = serializer.get_request_user_id()
+        return audit_data
+
+    def bulk_import_chunk(self, queryset, chunk, start, unique_fields, update_support, result, context=None):
+        model = queryset.model
+        context = context or {}
+        m2m_names = {field.name for field in model._meta.many_to_many}
+        # 盲索引列由加密字段计算, 不接受导入数据
+        concrete_fields = [field for field in model._meta.concrete_fields if not isinstance(field, BlindIndexField)]
+        concrete_names = {field.name for field in concrete_fields} | {field.attname for field in concrete_fields}
+        blind_index_names = {
+            field.name: field.blind_index_name
+            for field in concrete_fields
+            if isinstance(field, EncrypyField) and field.blind_index
+        }
+        is_bulk = self.is_import_serializer_bulk()
+        existing = self.get_import_existing(queryset, chunk, unique_fields)
+        preload = self.get_import_preload(chunk, context)
+        creates, updates, saves, update_fields, rows, seen = [], [], [], set(), {}, {}
+        for offset, ele in enumerate(chunk):
+            # 第一行为表头
+            row = start + offset + 2
+            key = self.get_import_key(ele, unique_fields)
+            if key is not None:
+                if key in rows:
+                    result["errors"].append({"row": row, "errors": f"与第{rows[key]}行数据重复"})
+                    continue
+                rows[key] = row
+            instance = existing.get(key) if key is not None else None
+            if instance and not update_support:
+                result["skipped"] += 1
+                continue
+            serializer = self.import_serializer_class(instance, data=ele, context=context)
+            self.apply_import_preload(serializer, preload)
+            if not serializer.is_valid():
+                result["errors"].append({"row": row, "errors": serializer.errors})
+                continue
+            errors = self.check_import_unique(serializer, instance, preload, seen, row)
+            if errors:
+                result["errors"].append({"row": row, "errors": errors})
+                continue
+            if not is_bulk:
+                saves.append((serializer, instance, row))
+                continue
+            validated_data = dict(serializer.validated_data)
+            m2m_data = {name: validated_data.pop(name) for name in m2m_names if name in validated_data}
+            # 只写入模型字段, 序列化器中的非模型字段不参与批量写入
+            validated_data = {name: value for name, value in validated_data.items() if name in concrete_names}
+            validated_data.update(self.get_import_audit_data(serializer, validated_data, instance))
+            if instance:
+                for attr, value in validated_data.items():
+                    setattr(instance, attr, value)
+                update_fields.update(validated_data.keys())
+                # 赋值加密字段时已同步盲索引, 批量更新时一并写入
+                update_fields.update(blind_index_names[name] for name in validated_data if name in blind_index_names)
+                updates.append((instance, m2m_data, row))
+            else:
+                try:
+                    creates.append((model(**validated_data), m2m_data, row))
+                except (TypeError, ValueError) as ex:
+                    result["errors"].append({"row": row, "errors": str(ex)})
+        db = router.db_for_write(model)
+        for serializer, instance, row in saves:
+            try:
+                with transaction.atomic(using=db):
+                    serializer.save()
+            except Exception as ex:
+                result["errors"].append({"row": row, "errors": str(ex)})
+                continue
+            result["updated" if instance else "created"] += 1
+        if not creates and not updates:
+            return
+        try:
+            with transaction.atomic(using=db):
+                new_objs = [ele[0] for ele in creates]
+                has_m2m = any(ele[1] for ele in creates)
+                if has_m2m and not connections[db].features.can_return_rows_from_bulk_insert:
+                    # 数据库不支持 bulk_create 返回主键时逐条保存, 以便写入多对多中间表
+                    for obj in new_objs:
+                        obj.save(using=db)
+                elif new_objs:
+                    model.objects.bulk_create(new_objs, batch_size=self.import_chunk_size)
+                if updates:
+                    if hasattr(model, "update_datetime"):
+                        now = timezone.now()
+                        for obj, m2m_data, row in updates:
+                            obj.update_datetime = now
+                        update_fields.add("update_datetime")
+                    model.objects.bulk_update(
+                        [ele[0] for ele in updates], list(update_fields), batch_size=self.import_chunk_size
+                    )
+                self.bulk_set_m2m(model, creates + updates)
+        except Exception as ex:
+            result["errors"].extend({"row": row, "errors": str(ex)} for obj, m2m_data, row in creates + updates)
+            return
+        # 批量写入不触发信号, 手动刷新总数缓存/权限/菜单/数据权限等缓存版本号
+        refresh_bulk_write(
+            model,
+            pks=[obj.pk for obj, m2m_data, row in creates + updates],
+            m2m_fields=[
+                field
+                for field in model._meta.many_to_many
+                if any(field.name in m2m_data for obj, m2m_data, row in creates + updates)
+            ],
+        )
+        result["created"] += len(creates)
+        result["updated"] += len(updates)
+
+    def bulk_set_m2m(self, model, items):
+        """
+        批量写入多对多中间表, 与 serializer 保存时 set() 的效果一致
+        :param model:
+        :param items: [(instance, {多对多字段名: [关联数据]}, 行号)]
+        :return:
+        """
+        for field in model._meta.many_to_many:
+            field_items = [(obj, m2m_data[field.name]) for obj, m2m_data, row in items if field.name in m2m_data]
+            if not field_items:
+                continue
+            through = field.remote_field.through
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+            through.objects.filter(**{f"{source}__in": [obj.pk for obj, values in field_items]}).delete()
+            through.objects.bulk_create(
+                [
+                    through(**{source: obj.pk, target: getattr(value, "pk", value)})
+                    for obj, values in field_items
+                    for value in values
+                ],
+                batch_size=self.import_chunk_size,
+            )
+
 
 class ExportSerializerMixin:
     """
@@ -153,6 +482,10 @@ class ExportSerializerMixin:
     export_field_label = []
     # 导出序列化器
     export_serializer_class = None
+    # 导出时每批读取及序列化的数据量
+    export_chunk_size = 1000
+    # 导出文件超过该字节数时写入磁盘临时文件
+    export_spool_size = 10 * 1024 * 1024
     # 表格表头最大宽度，默认50个字符
     export_column_width = 50
 
@@ -169,9 +502,43 @@ class ExportSerializerMixin:
             length += 2.1 if ord(char) > 256 else 1
         return round(length, 1) if length <= self.export_column_width else self.export_column_width
 
+    def get_export_rows(self, queryset):
+        """
+        分批读取并序列化导出数据, 内存中最多保留一批数据
+        :param queryset:
+        :return: 序列化后的数据生成器
+        """
+        chunk = []
+        for instance in queryset.iterator(chunk_size=self.export_chunk_size):
+            chunk.append(instance)
+            if len(chunk) >= self.export_chunk_size:
+                yield from self.export_serializer_class(chunk, many=True).data
+                chunk = []
+        if chunk:
+            yield from self.export_serializer_class(chunk, many=True).data
+
+    def format_export_row(self, results):
+        """
+        转换导出的单行数据
+        :param results: 序列化后的单行数据
+        :return: list
+        """
+        results_list = []
+        for result in results.values():
+            # 布尔值进行更新
+            if result is True:
+                result = "是"
+            elif result is False:
+                result = "否"
+            if isinstance(result, int):
+                result = str(result)
+            results_list.append(result)
+        return results_list
+
     def export_data(self, request: Request, *args, **kwargs):
         """
         导出功能
+        使用 openpyxl write-only 模式逐行写入临时文件, 再以流的方式返回, 内存占用与导出数量无关
         :param request:
         :param args:
         :param kwargs:
@@ -179,40 +546,30 @@ class ExportSerializerMixin:
         """
         assert self.export_field_label, "'%s' 请配置对应的导出模板字段。" % self.__class__.__name__
         queryset = self.filter_queryset(self.get_queryset())
-        data = self.export_serializer_class(queryset, many=True).data
-        # 导出excel 表
-        response = HttpResponse(content_type="application/msexcel")
-        response["Access-Control-Expose-Headers"] = f"Content-Disposition"
-        response["Content-Disposition"] = f'attachment;filename={quote(str(f"导出{get_verbose_name(queryset)}.xlsx"))}'
-        wb = Workbook()
-        ws = wb.active
+        rows = (self.format_export_row(results) for results in self.get_export_rows(queryset))
         header_data = ["序号", *self.export_field_label]
         df_len_max = [self.get_string_len(ele) for ele in header_data]
         row = get_column_letter(len(self.export_field_label) + 1)
         column = 1
-        ws.append(header_data)
-        for index, results in enumerate(data):
-            results_list = []
-            for inx, result in enumerate(results.values()):
-                # 布尔值进行更新
-                if result is True:
-                    result = "是"
-                elif result is False:
-                    result = "否"
-                if isinstance(result, int):
-                    result = str(result)
-                # 计算最大列宽度
+        # write-only 模式下列宽需在写入数据前设置, 以首批数据计算最大列宽
+        first_rows = list(islice(rows, self.export_chunk_size))
+        for results_list in first_rows:
+            for inx, result in enumerate(results_list):
                 result_column_width = self.get_string_len(result)
                 if result_column_width > df_len_max[inx + 1]:
                     df_len_max[inx + 1] = result_column_width
-
-                results_list.append(result)
-            ws.append([index + 1, *results_list])
-            column += 1
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
         # 　更新列宽
         for index, width in enumerate(df_len_max):
             ws.column_dimensions[get_column_letter(index + 1)].width = width
+        ws.append(header_data)
+        for index, results_list in enumerate(chain(first_rows, rows)):
+            ws.append([index + 1, *results_list])
+            column += 1
         tab = Table(displayName="Table", ref=f"A1:{row}{column}")  # 名称管理器
+        # write-only 模式下需手动添加表格列
+        tab.tableColumns = [TableColumn(id=index + 1, name=str(ele)) for index, ele in enumerate(header_data)]
         style = TableStyleInfo(
             name="TableStyleLight11",
             showFirstColumn=True,
@@ -221,6 +578,16 @@ class ExportSerializerMixin:
             showColumnStripes=True,
         )
         tab.tableStyleInfo = style
-        ws.add_table(tab)
-        wb.save(response)
+        # write-only 模式下 openpyxl 会提示表格需在写入数据前添加, 表格列已手动设置, 忽略该提示
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            ws.add_table(tab)
+        # 超过 export_spool_size 的文件写入磁盘临时文件
+        file = tempfile.SpooledTemporaryFile(max_size=self.export_spool_size)
+        wb.save(file)
+        file.seek(0)
+        # 导出excel 表
+        response = FileResponse(file, content_type="application/msexcel")
+        response["Access-Control-Expose-Headers"] = f"Content-Disposition"
+        response["Content-Disposition"] = f'attachment;filename={quote(str(f"导出{get_verbose_name(queryset)}.xlsx"))}'
         return response
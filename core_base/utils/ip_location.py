@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+离线IP地址库
+(1)build_ip_location 命令将 CSV 格式的IP段数据转换为按起始IP排序的二进制索引文件
+(2)查询时以 mmap 方式打开索引文件, 二分查找IP所在的IP段, 不加载整个文件到内存
+(3)IPv4 按 IPv4-mapped IPv6 地址保存, IPv4/IPv6 共用同一份索引
+
+索引文件格式:
+    文件头: MAGIC(4字节) + 版本号(uint32) + IP段数量(uint32)
+    IP段: 起始IP(16字节) + 结束IP(16字节) + 地区数据偏移(uint32), 按起始IP升序排列
+    地区数据: 长度(uint16) + 以制表符分隔的 LOCATION_FIELDS 字段值(utf-8), 相同地区只保存一份
+"""
+import csv
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CBIP"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+RANGE = struct.Struct("<16s16sI")
+LENGTH = struct.Struct("<H")
+LOCATION_FIELDS = (
+    "continent", "country", "province", "city", "district", "isp", "area_code",
+    "country_english", "country_code", "longitude", "latitude",
+)
+
+
+def ip_to_bytes(ip):
+    """
+    IP地址转换为16字节大端序, 字节序比较结果与IP大小一致
+    :param ip: IP地址字符串或整数(IPv4)
+    :return: bytes
+    """
+    if isinstance(ip, str) and ip.strip().isdigit():
+        ip = int(ip.strip())
+    address = ipaddress.ip_address(ip.strip() if isinstance(ip, str) else ip)
+    if address.version == 4:
+        address = ipaddress.IPv6Address(f"::ffff:{address}")
+    return address.packed
+
+
+def build_index(csv_path, output_path, encoding="utf-8"):
+    """
+    将 CSV 转换为索引文件
+    CSV 需包含表头, start_ip/end_ip 为IP段起止地址(IP字符串或IPv4整数), 其它列为 LOCATION_FIELDS 中的字段
+    :param csv_path: CSV 文件路径
+    :param output_path: 索引文件路径, 先写入临时文件再替换, 不影响正在使用旧文件的进程
+    :param encoding: CSV 文件编码
+    :return: IP段数量
+    """
+    ranges = []
+    locations = {}
+    data = bytearray()
+    with open(csv_path, newline="", encoding=encoding) as f:
+        for row in csv.DictReader(f):
+            start, end = ip_to_bytes(row["start_ip"]), ip_to_bytes(row["end_ip"])
+            if start > end:
+                start, end = end, start
+            location = "\t".join((row.get(field) or "").replace("\t", " ").strip() for field in LOCATION_FIELDS)
+            offset = locations.get(location)
+            if offset is None:
+                encoded = location.encode("utf-8")
+                offset = locations[location] = len(data)
+                data += LENGTH.pack(len(encoded)) + encoded
+            ranges.append((start, end, offset))
+    ranges.sort()
+    data_start = HEADER.size + RANGE.size * len(ranges)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ranges)))
+        for start, end, offset in ranges:
+            f.write(RANGE.pack(start, end, data_start + offset))
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    return len(ranges)
+
+
+class IpLocator:
+    """
+    IP地址库查询
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION or len(self._mmap) < HEADER.size + RANGE.size * self.count:
+            self._mmap.close()
+            raise ValueError(f"无效的IP地址库文件: {path}")
+        self.mtime = os.path.getmtime(path)
+
+    def _read_location(self, offset):
+        length, = LENGTH.unpack_from(self._mmap, offset)
+        start = offset + LENGTH.size
+        values = self._mmap[start:start + length].decode("utf-8").split("\t")
+        return dict(zip(LOCATION_FIELDS, values))
+
+    def lookup(self, ip):
+        """
+        查询IP所在地区
+        :param ip: IP地址
+        :return: 地区字典, 未找到时返回 None
+        """
+        try:
+            key = ip_to_bytes(ip)
+        except ValueError:
+            return None
+        # 二分查找最后一个起始IP <= key 的IP段
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self._mmap[HEADER.size + middle * RANGE.size:HEADER.size + middle * RANGE.size + 16]
+            if start <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        _, end, offset = RANGE.unpack_from(self._mmap, HEADER.size + (low - 1) * RANGE.size)
+        if key > end:
+            return None
+        return self._read_location(offset)
+
+    def close(self):
+        self._mmap.close()
+
+
+_locator = None
+_locator_checked = 0
+# 打开失败的索引文件(路径, 修改时间), 文件更新前不再重试
+_locator_failed = None
+_locator_lock = threading.Lock()
+
+
+def get_ip_locator():
+    """
+    获取 IP_LOCATION_DB_PATH 对应的查询对象, 索引文件更新后自动重新打开
+    :return: IpLocator, 未配置、文件不存在或文件无效时返回 None
+    """
+    global _locator, _locator_checked, _locator_failed
+    path = getattr(settings, "IP_LOCATION_DB_PATH", None)
+    if not path:
+        return None
+    now = time.monotonic()
+    if _locator is not None and _locator.path == path and now - _locator_checked < 60:
+        return _locator
+    with _locator_lock:
+        _locator_checked = now
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            _locator = None
+            return None
+        if _locator_failed == (path, mtime):
+            return None
+        if _locator is None or _locator.path != path or _locator.mtime != mtime:
+            # 旧文件的 mmap 由正在查询的线程持有引用, 不主动关闭
+            try:
+                _locator = IpLocator(path)
+            except (OSError, ValueError, struct.error):
+                # 文件为空、被截断或格式错误时按未配置地址库处理, 不影响登录
+                logger.exception("IP地址库文件无效: %s", path)
+                _locator, _locator_failed = None, (path, mtime)
+        return _locator
+
+
+def lookup_ip(ip):
+    """
+    查询IP所在地区
+    :param ip: IP地址
+    :return: 地区字典, 未配置地址库或未找到时返回 None
+    """
+    locator = get_ip_locator()
+    if locator is None:
+        return None
+    return locator.lookup(ip)
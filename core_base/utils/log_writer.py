@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+日志异步批量写入
+(1)请求线程只把构建好的日志记录放入有界队列
+(2)后台线程按数量(API_LOG_BATCH_SIZE)或时间(API_LOG_FLUSH_INTERVAL)触发 bulk_create
+(3)队列已满时按 API_LOG_DROP_POLICY 处理: drop_new 丢弃新日志, drop_oldest 丢弃最旧日志, sync 同步写入
+(4)进程退出时写完队列中剩余的日志
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from core_base import dispatch
+from core_base.utils.cache_version import bump_version, get_model_version_name
+
+logger = logging.getLogger(__name__)
+
+DROP_NEW = "drop_new"
+DROP_OLDEST = "drop_oldest"
+SYNC = "sync"
+
+_STOP = object()
+
+
+class LogWriter:
+    """
+    日志异步批量写入器
+    """
+
+    def __init__(self, model, max_queue_size=10000, batch_size=200, flush_interval=1, drop_policy=DROP_NEW):
+        self.model = model
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # fork 之后后台线程不会被继承, 按进程重新启动
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue_size)
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="core-base-log-writer", daemon=True)
+            self._thread.start()
+
+    def _incr(self, name, count=1):
+        # 请求线程与后台线程都会更新统计数, 加锁避免丢失计数
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def put(self, record):
+        """
+        放入一条日志记录
+        :param record: 日志字段字典
+        :return: 是否成功放入队列或写入
+        """
+        self._ensure_started()
+        if dispatch.is_tenants_mode():
+            record = {**record, "_schema_name": connection.tenant.schema_name}
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+        if self.drop_policy == SYNC:
+            self._write([record])
+            return True
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self._incr("dropped")
+                self._queue.put_nowait(record)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+        self._incr("dropped")
+        return False
+
+    def stats(self):
+        """
+        写入统计
+        :return:
+        """
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def stop(self, timeout=10):
+        """
+        停止后台线程, 并写完队列中剩余的日志
+        :param timeout: 等待秒数
+        :return:
+        """
+        if not self._thread or not self._thread.is_alive() or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                record = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                record = None
+            if record is _STOP:
+                self._drain(batch)
+                return
+            if record is not None:
+                batch.append(record)
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+    def _drain(self, batch):
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _STOP:
+                batch.append(record)
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start + self.batch_size])
+
+    def _write(self, batch):
+        # 租户模式下按 schema 分组写入
+        groups = {}
+        for record in batch:
+            record = dict(record)
+            groups.setdefault(record.pop("_schema_name", None), []).append(self.model(**record))
+        for schema_name, objs in groups.items():
+            try:
+                if schema_name:
+                    from django_tenants.utils import schema_context
+
+                    with schema_context(schema_name):
+                        self.model.objects.bulk_create(objs)
+                        bump_version(get_model_version_name(self.model))
+                else:
+                    self.model.objects.bulk_create(objs)
+                    bump_version(get_model_version_name(self.model))
+                self._incr("written", len(objs))
+            except Exception:
+                self._incr("failed", len(objs))
+                logger.exception("日志批量写入失败")
+        close_old_connections()
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """
+    获取全局日志写入器
+    :return: LogWriter
+    """
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                from core_base.models import Logs
+
+                _log_writer = LogWriter(
+                    Logs,
+                    max_queue_size=getattr(settings, "API_LOG_QUEUE_SIZE", 10000),
+                    batch_size=getattr(settings, "API_LOG_BATCH_SIZE", 200),
+                    flush_interval=getattr(settings, "API_LOG_FLUSH_INTERVAL", 1),
+                    drop_policy=getattr(settings, "API_LOG_DROP_POLICY", DROP_NEW),
+                )
+                atexit.register(_log_writer.stop)
+    return _log_writer
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+登录日志异步写入
+(1)登录请求中只记录IP、User-Agent、用户及登录时间等原始信息
+(2)后台线程按批取出, 在线程池(LOGIN_LOG_WORKERS)中解析IP归属地及 User-Agent 后 bulk_create
+(3)队列已满时同步写入; 写入失败或进程退出时未处理的原始信息保存到 LoginLogQueue 表
+(4)后台线程启动时重新处理 LoginLogQueue 中的数据, 租户模式下通过 flush_login_logs 命令处理
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from core_base import dispatch
+from core_base.models import Logs, LoginLogQueue
+from core_base.utils.cache_version import bump_version, get_model_version_name
+from core_base.utils.log_writer import LogWriter, SYNC, _STOP
+from core_base.utils.request_util import build_login_log
+
+logger = logging.getLogger(__name__)
+
+LOGIN_LOG_FIELDS = ("username", "creator", "dept_belong_id", "request_ip", "request_agent", "login_datetime")
+# 写入时间与登录时间相差超过该值时, 将日志的创建时间修正为登录时间
+MAX_DELAY = timedelta(seconds=5)
+
+
+def schema_context(schema_name):
+    if not schema_name:
+        return nullcontext()
+    from django_tenants.utils import schema_context
+
+    return schema_context(schema_name)
+
+
+class LoginLogPipeline(LogWriter):
+    """
+    登录日志异步写入器
+    """
+
+    def __init__(self, max_queue_size=10000, batch_size=100, flush_interval=1, workers=2):
+        super().__init__(Logs, max_queue_size, batch_size, flush_interval, drop_policy=SYNC)
+        self.workers = workers
+        self._executor = None
+        self._executor_pid = None
+
+    def _get_executor(self):
+        # fork 之后线程池不可用, 按进程重新创建
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="core-base-login-log")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def insert(self, facts_list):
+        """
+        解析登录原始信息并批量写入登录日志
+        :param facts_list: 原始信息列表
+        :return:
+        """
+        objs = [Logs(**record) for record in self._get_executor().map(build_login_log, facts_list)]
+        Logs.objects.bulk_create(objs)
+        delayed = []
+        for obj, facts in zip(objs, facts_list):
+            if obj.pk and obj.create_datetime - facts["login_datetime"] > MAX_DELAY:
+                obj.create_datetime = facts["login_datetime"]
+                delayed.append(obj)
+        if delayed:
+            Logs.objects.bulk_update(delayed, ["create_datetime"])
+        bump_version(get_model_version_name(Logs))
+
+    def save_pending(self, facts_list):
+        """
+        保存未处理的登录原始信息
+        :param facts_list: 原始信息列表
+        :return:
+        """
+        try:
+            LoginLogQueue.objects.bulk_create([LoginLogQueue(**facts) for facts in facts_list])
+        except Exception:
+            self._incr("failed", len(facts_list))
+            logger.exception("登录日志保存失败")
+
+    def recover(self):
+        """
+        重新处理 LoginLogQueue 中的登录原始信息, 多进程同时处理时跳过已被锁定的数据
+        :return: 处理数量
+        """
+        count = 0
+        while True:
+            with transaction.atomic():
+                queryset = LoginLogQueue.objects.order_by("id").select_for_update(
+                    skip_locked=connection.features.has_select_for_update_skip_locked
+                )
+                rows = list(queryset[:self.batch_size])
+                if not rows:
+                    return count
+                self.insert([{field: getattr(row, field) for field in LOGIN_LOG_FIELDS} for row in rows])
+                LoginLogQueue.objects.filter(id__in=[row.id for row in rows]).delete()
+            count += len(rows)
+
+    def _group(self, batch):
+        groups = {}
+        for record in batch:
+            record = dict(record)
+            groups.setdefault(record.pop("_schema_name", None), []).append(record)
+        return groups
+
+    def _run(self):
+        if not dispatch.is_tenants_mode():
+            try:
+                self.recover()
+            except Exception:
+                logger.exception("待处理登录日志处理失败")
+            close_old_connections()
+        super()._run()
+
+    def _write(self, batch):
+        for schema_name, facts_list in self._group(batch).items():
+            with schema_context(schema_name):
+                try:
+                    self.insert(facts_list)
+                    self._incr("written", len(facts_list))
+                except Exception:
+                    logger.exception("登录日志写入失败, 保存到待处理登录日志")
+                    self.save_pending(facts_list)
+        close_old_connections()
+
+    def _drain(self, batch):
+        # 进程退出时不再解析归属地, 未处理的原始信息直接保存
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _STOP:
+                batch.append(record)
+        for schema_name, facts_list in self._group(batch).items():
+            with schema_context(schema_name):
+                self.save_pending(facts_list)
+        close_old_connections()
+
+
+_login_log_pipeline = None
+_login_log_pipeline_lock = threading.Lock()
+
+
+def get_login_log_pipeline():
+    """
+    获取全局登录日志写入器
+    :return: LoginLogPipeline
+    """
+    global _login_log_pipeline
+    if _login_log_pipeline is None:
+        with _login_log_pipeline_lock:
+            if _login_log_pipeline is None:
+                _login_log_pipeline = LoginLogPipeline(
+                    max_queue_size=getattr(settings, "LOGIN_LOG_QUEUE_SIZE", 10000),
+                    batch_size=getattr(settings, "LOGIN_LOG_BATCH_SIZE", 100),
+                    flush_interval=getattr(settings, "LOGIN_LOG_FLUSH_INTERVAL", 1),
+                    workers=getattr(settings, "LOGIN_LOG_WORKERS", 2),
+                )
+                atexit.register(_login_log_pipeline.stop)
+    return _login_log_pipeline
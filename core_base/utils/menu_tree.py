@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+菜单树
+(1)一次查询菜单、一次查询菜单按钮, 在内存中按上级菜单组装菜单树
+(2)组装好的菜单树按角色集合缓存在进程内, 菜单/菜单按钮/角色菜单变更时失效
+"""
+from core_base.models import Menu, MenuButton, Role
+from core_base.utils.cache_version import VersionedCache
+from core_base.utils.permission import get_user_role_ids
+
+# 菜单/菜单按钮/角色菜单变更时递增的版本号名称
+MENU_VERSION = "menu"
+# (是否管理菜单, 角色id集合) => 菜单树
+_menu_tree_cache = VersionedCache(MENU_VERSION, maxsize=256)
+
+
+def get_menu_data(menu, buttons_map):
+    return {"id": menu["id"], "path": menu["path"], "name": menu["name"],
+            "component": menu["component"], "meta": menu["meta"], "label": (menu["meta"] or {}).get('title', ''),
+            "menu_button_list": buttons_map.get(menu["id"], [])}
+
+
+# 递归获取菜单
+def get_child_menu(childs, menu_ids, tree_ids, children_map, buttons_map, is_admin=False):
+    '''
+    :param childs: 当前节点的下级菜单
+    :param menu_ids: 有权限的菜单id集合, None 表示全部菜单
+    :param tree_ids: 已加入菜单树的菜单id集合
+    :param children_map: {上级菜单id: [菜单, ...]}
+    :param buttons_map: {菜单id: [菜单按钮, ...]}
+    :return [{"id": child.id, "title": child.title, "children": []}]:
+    '''
+    children = []
+    for child in childs:
+        if (menu_ids is None or child["id"] in menu_ids) and child["id"] not in tree_ids:
+            data = get_menu_data(child, buttons_map)
+            tree_ids.add(child["id"])
+            _childs = [menu for menu in children_map.get(child["id"], []) if is_admin or menu["status"]]
+            if _childs:
+                data["children"] = get_child_menu(_childs, menu_ids, tree_ids, children_map, buttons_map, is_admin)
+            children.append(data)
+    return children
+
+
+def build_menu_tree(menu_ids=None, is_admin=False):
+    """
+    组装菜单树
+    :param menu_ids: 有权限的菜单id集合, None 表示全部菜单
+    :param is_admin: 是否为管理菜单, 管理菜单不过滤菜单状态
+    :return:
+    """
+    children_map = {}
+    menus = Menu.objects.order_by('sort').values('id', 'parent_id', 'path', 'name', 'component', 'meta', 'status')
+    for menu in menus:
+        children_map.setdefault(menu["parent_id"], []).append(menu)
+    buttons = MenuButton.objects.all() if menu_ids is None else MenuButton.objects.filter(menu_id__in=menu_ids)
+    buttons_map = {}
+    for button in buttons.values("id", "name", "value", "menu_id"):
+        buttons_map.setdefault(button.pop("menu_id"), []).append(button)
+    tree, tree_ids = [], set()
+    for menu in children_map.get(None, []):
+        if menu_ids is not None and menu["id"] not in menu_ids:
+            continue
+        if not is_admin and not menu["status"]:
+            continue
+        if menu["id"] not in tree_ids:
+            menu_data = get_menu_data(menu, buttons_map)
+            tree_ids.add(menu["id"])
+            childs = children_map.get(menu["id"], [])
+            if childs:
+                menu_data["children"] = get_child_menu(childs, menu_ids, tree_ids, children_map, buttons_map, is_admin)
+            tree.append(menu_data)
+    return tree
+
+
+def get_menu_tree(user, is_admin=False):
+    """
+    获取用户的菜单树, 按角色集合缓存, 返回的数据为共享缓存, 请勿修改
+    :param user:
+    :param is_admin: 是否为管理菜单
+    :return:
+    """
+    if user.is_superuser:
+        return _menu_tree_cache.get_or_set((is_admin, None), lambda: build_menu_tree(None, is_admin))
+    role_ids = tuple(sorted(get_user_role_ids(user)))
+
+    def builder():
+        menu_ids = set(Role.objects.filter(id__in=role_ids).values_list('menu__id', flat=True))
+        menu_ids.discard(None)
+        return build_menu_tree(menu_ids, is_admin)
+
+    return _menu_tree_cache.get_or_set((is_admin, role_ids), builder)
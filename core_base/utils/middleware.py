@@ -1,16 +1,20 @@
 """
 日志 django中间件
 """
+import base64
 import json
+import random
+import re
+import zlib
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.utils.deprecation import MiddlewareMixin
 
 from core_base.models import Logs
+from core_base.utils.log_writer import get_log_writer
 from core_base.utils.request_util import get_request_user, get_request_ip, get_request_data, get_request_path, get_os, \
-    get_browser, get_verbose_name
-from user_agents import parse
+    get_browser, get_verbose_name, get_user_agent
 
 
 class ApiLoggingMiddleware(MiddlewareMixin):
@@ -22,13 +26,62 @@ class ApiLoggingMiddleware(MiddlewareMixin):
         super().__init__(get_response)
         self.enable = getattr(settings, 'API_LOG_ENABLE', None) or False
         self.methods = getattr(settings, 'API_LOG_METHODS', None) or set()
-        self.log_id = None
+        # 异步批量写入: 响应时构建完整日志放入队列, 由后台线程 bulk_create
+        self.async_write = getattr(settings, 'API_LOG_ASYNC', False)
+        skip_paths = getattr(settings, 'API_LOG_SKIP_PATHS', None) or []
+        self.skip_pattern = re.compile('|'.join(f'(?:{path})' for path in skip_paths)) if skip_paths else None
+        self.sample_rate = getattr(settings, 'API_LOG_SAMPLE_RATE', 1)
+        self.sample_rates = [
+            (re.compile(path), rate) for path, rate in (getattr(settings, 'API_LOG_SAMPLE_RATES', None) or {}).items()
+        ]
+        self.body_max_bytes = getattr(settings, 'API_LOG_BODY_MAX_BYTES', 10240)
+        self.result_max_bytes = getattr(settings, 'API_LOG_RESULT_MAX_BYTES', 10240)
+        self.compress = getattr(settings, 'API_LOG_COMPRESS', False)
 
-    @classmethod
-    def __handle_request(cls, request):
+    def get_sample_rate(self, path):
+        for pattern, rate in self.sample_rates:
+            if pattern.match(path):
+                return rate
+        return self.sample_rate
+
+    def should_log(self, request):
+        """
+        是否记录当前请求: 请求方法、跳过的接口、采样率
+        :param request:
+        :return:
+        """
+        if not self.enable or not (self.methods == 'ALL' or request.method in self.methods):
+            return False
+        if self.skip_pattern and self.skip_pattern.match(request.path):
+            return False
+        rate = self.get_sample_rate(request.path)
+        return rate >= 1 or random.random() < rate
+
+    def cap(self, value, max_bytes):
+        """
+        限制日志字段大小, 超出 max_bytes 时压缩(以 zlib: 开头的 base64)或截断
+        :param value: 字段值
+        :param max_bytes: 最大字节数
+        :return: str
+        """
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False, default=str)
+        data = value.encode('utf-8')
+        if not max_bytes or len(data) <= max_bytes:
+            return value
+        if self.compress:
+            compressed = 'zlib:' + base64.b64encode(zlib.compress(data)).decode()
+            if len(compressed) <= max_bytes:
+                return compressed
+        return data[:max(max_bytes - 3, 0)].decode('utf-8', errors='ignore') + '...'
+
+    def __handle_request(self, request):
         request.request_ip = get_request_ip(request)
-        request.request_data = get_request_data(request)
         request.request_path = get_request_path(request)
+        # 只为需要记录日志的请求解析请求参数
+        request.api_log = self.should_log(request)
+        if request.api_log:
+            request.request_data = get_request_data(request)
 
     def __handle_response(self, request, response):
         # request_data,request_ip由PermissionInterfaceMiddleware中间件中添加的属性
@@ -49,32 +102,34 @@ class ApiLoggingMiddleware(MiddlewareMixin):
             'request_ip': getattr(request, 'request_ip', 'unknown'),
             'creator': user.id if not isinstance(user, AnonymousUser) else None,
             'username':user.username if not isinstance(user, AnonymousUser) else None,
-            'dept_belong_id': getattr(request.user, 'dept_id', None),
+            'dept_belong_id': getattr(user, 'dept_id', None),
             'request_method': request.method,
             'request_path': request.request_path,
-            'request_body': body,
+            'request_body': self.cap(body, self.body_max_bytes),
             'response_code': response.data.get('code'),
             'request_os': get_os(request),
             'request_browser': get_browser(request),
             'request_msg': request.session.get('request_msg'),
             'status': True if response.data.get('code') in [2000, ] else False,
-            'json_result': {"code": response.data.get('code'), "msg": response.data.get('msg')},
+            'json_result': self.cap({"code": response.data.get('code'), "msg": response.data.get('msg')},
+                                    self.result_max_bytes),
             'logtype': 4,
-            'request_agent': str(parse(request.META['HTTP_USER_AGENT'])),
+            'request_agent': get_user_agent(request).pretty,
             'execute_result': "操作成功"
         }
-        log, creat = Logs.objects.update_or_create(defaults=info, id=self.log_id)
-        if not log.request_modular and settings.API_MODEL_MAP.get(request.request_path, None):
-            log.request_modular = settings.API_MODEL_MAP[request.request_path]
-            log.save()
+        info['request_modular'] = getattr(request, 'request_modular', None) or settings.API_MODEL_MAP.get(
+            request.request_path, None)
+        if self.async_write:
+            get_log_writer().put(info)
+            return
+        # 日志在响应时一次写入
+        Logs.objects.create(**info)
 
     def process_view(self, request, view_func, view_args, view_kwargs):
+        # 请求模块保存在当前请求上, 多线程/异步部署时各请求互不影响
         if hasattr(view_func, 'cls') and hasattr(view_func.cls, 'queryset'):
-            if self.enable:
-                if self.methods == 'ALL' or request.method in self.methods:
-                    log = Logs(request_modular=get_verbose_name(view_func.cls.queryset))
-                    log.save()
-                    self.log_id = log.id
+            if getattr(request, 'api_log', False):
+                request.request_modular = get_verbose_name(view_func.cls.queryset)
 
         return
 
@@ -88,7 +143,6 @@ class ApiLoggingMiddleware(MiddlewareMixin):
         :param response:
         :return:
         """
-        if self.enable:
-            if self.methods == 'ALL' or request.method in self.methods:
-                self.__handle_response(request, response)
+        if getattr(request, 'api_log', False):
+            self.__handle_response(request, response)
         return response
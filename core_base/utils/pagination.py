@@ -1,18 +1,184 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import hashlib
+import json
+import operator
 from collections import OrderedDict
+from functools import partial, reduce
 
+from django.apps import apps
+from django.conf import settings
 from django.core import paginator
+from django.core.exceptions import EmptyResultSet, ValidationError as DjangoValidationError
 from django.core.paginator import Paginator as DjangoPaginator
-from rest_framework.pagination import PageNumberPagination
+from django.db import connection, connections
+from django.db.models import Q, Subquery
+from django.db.models.sql import Query
+from django.db.models.sql.where import WhereNode
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
 
+from core_base import dispatch
+from core_base.utils.cache_version import get_model_version_name, get_shared_cache, get_version
+
+
+# 总数统计方式: exact 精确统计, cached 精确统计并缓存, estimated 无过滤条件时使用数据库统计信息估算
+COUNT_EXACT = "exact"
+COUNT_CACHED = "cached"
+COUNT_ESTIMATED = "estimated"
+
+
+_count_cache_models = None
+
+
+def get_count_cache_models():
+    """
+    启用总数缓存的模型, 这些模型的 post_save/post_delete 信号会递增模型写入版本号
+    PAGINATION_COUNT_CACHE_MODELS 未配置时, PAGINATION_COUNT_STRATEGY 不为 exact 则为 core_base 的全部模型
+    :return: frozenset
+    """
+    global _count_cache_models
+    if _count_cache_models is None:
+        labels = getattr(settings, "PAGINATION_COUNT_CACHE_MODELS", None)
+        if labels is not None:
+            models = [apps.get_model(label) for label in labels]
+        elif getattr(settings, "PAGINATION_COUNT_STRATEGY", COUNT_EXACT) != COUNT_EXACT:
+            models = apps.get_app_config("core_base").get_models()
+        else:
+            models = []
+        _count_cache_models = frozenset(models)
+    return _count_cache_models
+
+
+def get_cached_count(queryset):
+    """
+    精确统计并缓存, 按查询语句及模型写入版本号缓存, 数据变更后失效, PAGINATION_COUNT_CACHE_TTL 秒后过期
+    bulk_create/update/delete 等 queryset 级写入不触发信号, 需调用方自行递增模型写入版本号, 否则过期前总数不会更新
+    未启用总数缓存的模型直接精确统计, 关联查询或子查询会读取其它表, 缓存无法随其它表的变更失效, 同样直接精确统计
+    :param queryset:
+    :return:
+    """
+    if queryset.model not in get_count_cache_models() or has_related_tables(queryset):
+        return queryset.count()
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        # .none() 或空的 __in 条件不会查询数据库
+        return 0
+    digest = hashlib.md5(repr((sql, params)).encode()).hexdigest()
+    model = queryset.model
+    schema_name = f"{connection.tenant.schema_name}:" if dispatch.is_tenants_mode() else ""
+    key = f"core_base:count:{schema_name}{model._meta.label_lower}:{get_version(get_model_version_name(model))}:{digest}"
+    cache = get_shared_cache()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, getattr(settings, "PAGINATION_COUNT_CACHE_TTL", 60))
+    return count
+
+
+def has_related_tables(queryset):
+    """
+    查询是否读取了模型自身以外的表(关联查询、子查询、组合查询)
+    """
+    query = queryset.query
+    if query.combinator or len(query.alias_map) > 1:
+        return True
+    nodes = [query.where, *query.annotations.values()]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (Query, Subquery)):
+            return True
+        if isinstance(node, WhereNode):
+            nodes.extend(node.children)
+        elif hasattr(node, "get_source_expressions"):
+            nodes.extend(expression for expression in node.get_source_expressions() if expression is not None)
+    return False
+
+
+def is_unfiltered(queryset):
+    """
+    是否为无过滤条件的整表查询, 软删除模型默认的 is_deleted 条件视为无过滤条件
+    """
+    query = queryset.query
+    if query.distinct or query.group_by or query.combinator or len(query.alias_map) > 1:
+        return False
+    if not query.where:
+        return True
+    return query.where == queryset.model._default_manager.all().query.where
+
+
+def get_estimated_count(queryset):
+    """
+    使用数据库统计信息估算整表数据量, 仅支持 PostgreSQL/MySQL 的无过滤条件查询
+    :param queryset:
+    :return: 估算数量, 不支持估算或数据量小于 PAGINATION_COUNT_ESTIMATE_THRESHOLD 时返回 None
+    """
+    if not is_unfiltered(queryset):
+        return None
+    db_connection = connections[queryset.db]
+    db_table = queryset.model._meta.db_table
+    if db_connection.vendor == "postgresql":
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)"
+    elif db_connection.vendor == "mysql":
+        sql = "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+    else:
+        return None
+    with db_connection.cursor() as cursor:
+        cursor.execute(sql, [db_table])
+        row = cursor.fetchone()
+    # 数据量较小时精确统计的开销可以忽略
+    if not row or row[0] is None or row[0] < getattr(settings, "PAGINATION_COUNT_ESTIMATE_THRESHOLD", 10000):
+        return None
+    return int(row[0])
+
+
+class CountPaginator(DjangoPaginator):
+    """
+    按 count_strategy 统计总数的分页器, approximate 表示总数是否为估算值
+    """
+
+    def __init__(self, *args, count_strategy=COUNT_EXACT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count_strategy = count_strategy
+        self.approximate = False
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, "query") or self.count_strategy == COUNT_EXACT:
+            return super().count
+        if self.count_strategy == COUNT_ESTIMATED:
+            count = get_estimated_count(self.object_list)
+            if count is not None:
+                self.approximate = True
+                return count
+        return get_cached_count(self.object_list)
+
 
 class CustomPagination(PageNumberPagination):
+    """
+    页码分页
+    总数统计方式依次取视图的 count_strategy、本类的 count_strategy、PAGINATION_COUNT_STRATEGY 配置
+    """
     page_size = 10
     page_size_query_param = "limit"
     max_page_size = 100
     django_paginator_class = DjangoPaginator
+    count_strategy = None
+
+    def get_count_strategy(self, view):
+        return (
+            getattr(view, "count_strategy", None)
+            or self.count_strategy
+            or getattr(settings, "PAGINATION_COUNT_STRATEGY", COUNT_EXACT)
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.django_paginator_class = partial(CountPaginator, count_strategy=self.get_count_strategy(view))
+        return super().paginate_queryset(queryset, request, view)
 
     def get_paginated_response(self, data):
         code = 200
@@ -20,6 +186,7 @@ class CustomPagination(PageNumberPagination):
         res = {
             "page": int(self.get_page_number(self.request, paginator)) or 1,
             "total": self.page.paginator.count,
+            "approximate": getattr(self.page.paginator, "approximate", False),
             "limit": int(self.get_page_size(self.request)) or 10,
             "list": data
         }
@@ -34,3 +201,115 @@ class CustomPagination(PageNumberPagination):
             # ('total',self.page.paginator.count),
             ('data', res),
         ]))
+
+
+class CustomCursorPagination(BasePagination):
+    """
+    游标(keyset)分页, 返回格式与 CustomPagination 一致, 视图设置 pagination_class = CustomCursorPagination 启用
+    (1)按 ordering 中的字段组合定位, 翻到任意深度都只需 WHERE (字段组合) > 游标 LIMIT n, 不产生 OFFSET 扫描
+    (2)ordering 需为有索引且组合唯一、非空的本表字段, 默认 ("-id",) 即按创建顺序倒序, 视图可通过 cursor_ordering 覆盖
+       create_datetime 可为空且无索引, 为空的数据会被游标条件跳过, 请勿直接用作游标字段
+    (3)next/previous 为不透明游标, 通过 cursor 参数传回
+    """
+    page_size = 10
+    page_size_query_param = "limit"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    ordering = ("-id",)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, view):
+        ordering = getattr(view, "cursor_ordering", None) or self.ordering
+        return [(field.lstrip("-"), field.startswith("-")) for field in ordering]
+
+    def encode_cursor(self, obj, reverse):
+        values = []
+        for field_name, _ in self.ordering_fields:
+            value = getattr(obj, self.model._meta.get_field(field_name).attname)
+            values.append(value.isoformat() if hasattr(value, "isoformat") else value)
+        data = json.dumps({"v": values, "r": reverse}, separators=(",", ":"), default=str)
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+            if len(data["v"]) != len(self.ordering_fields):
+                raise ValueError(cursor)
+            values = [
+                self.model._meta.get_field(field_name).to_python(value)
+                for (field_name, _), value in zip(self.ordering_fields, data["v"])
+            ]
+            return values, bool(data.get("r"))
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise NotFound("无效的分页游标")
+
+    def get_keyset_query(self, values, reverse):
+        """
+        按字段组合生成游标之后的条件: (a > x) or (a = x and b > y) ...
+        """
+        conditions = []
+        for index, (field_name, descending) in enumerate(self.ordering_fields):
+            lookup = "lt" if descending != reverse else "gt"
+            condition = {name: value for (name, _), value in zip(self.ordering_fields[:index], values)}
+            condition[f"{field_name}__{lookup}"] = values[index]
+            conditions.append(Q(**condition))
+        return reduce(operator.or_, conditions)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.model = queryset.model
+        self.page_size = self.get_page_size(request)
+        self.ordering_fields = self.get_ordering(view)
+        cursor = request.query_params.get(self.cursor_query_param)
+        values, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+
+        order_by = [
+            f"-{field_name}" if descending != reverse else field_name
+            for field_name, descending in self.ordering_fields
+        ]
+        queryset = queryset.order_by(*order_by)
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_query(values, reverse))
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.next_cursor = None
+        self.previous_cursor = None
+        if results:
+            # 向后翻页时多取到数据说明还有下一页, 向前翻页时游标位置之后必然还有数据
+            if has_more or reverse:
+                self.next_cursor = self.encode_cursor(results[-1], False)
+            if (reverse and has_more) or (not reverse and cursor):
+                self.previous_cursor = self.encode_cursor(results[0], True)
+        return results
+
+    def get_paginated_response(self, data):
+        code = 200
+        msg = 'success'
+        res = {
+            "next": self.next_cursor,
+            "previous": self.previous_cursor,
+            "limit": self.page_size,
+            "list": data
+        }
+        if not data:
+            code = 200
+            msg = "暂无数据"
+            res['list'] = []
+
+        return Response(OrderedDict([
+            ('code', code),
+            ('msg', msg),
+            ('data', res),
+        ]))
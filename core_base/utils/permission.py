@@ -3,10 +3,11 @@
 import re
 
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import F
 from rest_framework.permissions import BasePermission
 
-from core_base.models import ApiWhiteList
+from core_base.models import ApiWhiteList, Role
+from core_base.utils.cache_version import VersionedCache
+from core_base.utils.data_scope import get_auth_claims
 
 
 def ValidationApi(reqApi, validApi):
@@ -53,6 +54,121 @@ def ReUUID(api):
         return None
 
 
+class ApiMatcher:
+    """
+    预编译的接口权限匹配器
+    (1)不含 {id} 及正则字符的接口按 (接口, 请求方法) 放入集合, 直接查找
+    (2)其余接口按请求方法合并为一个预编译正则, 一次匹配完成
+    """
+    REGEX_CHARS = re.compile(r"[\\.^$*+?{}\[\]|()]")
+
+    def __init__(self, api_list):
+        """
+        :param api_list: [(接口地址, 请求方法), ...]
+        """
+        exact_apis = set()
+        method_patterns = {}
+        for api, method in api_list:
+            if not api:
+                continue
+            method = str(method)
+            if "{id}" not in api and not self.REGEX_CHARS.search(api):
+                exact_apis.add((api.lower(), method))
+                continue
+            pattern = api.replace("{id}", "[a-zA-Z0-9-]+")
+            try:
+                re.compile(pattern)
+            except re.error:
+                continue
+            method_patterns.setdefault(method, []).append(f"(?:{pattern})")
+        self.exact_apis = frozenset(exact_apis)
+        self.method_patterns = {
+            method: re.compile(f"(?:{'|'.join(patterns)})$", re.I) for method, patterns in method_patterns.items()
+        }
+
+    def match(self, api, method):
+        """
+        :param api: 当前请求的接口
+        :param method: 当前请求方法在 METHOD_LIST 中的下标
+        :return: True或者False
+        """
+        method = str(method)
+        if (api.lower(), method) in self.exact_apis:
+            return True
+        pattern = self.method_patterns.get(method)
+        return bool(pattern and pattern.match(api))
+
+
+# 角色/菜单按钮变更时递增的版本号名称
+PERMISSION_VERSION = "permission"
+# 接口白名单变更时递增的版本号名称
+API_WHITE_LIST_VERSION = "api_white_list"
+METHOD_LIST = ['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH']
+# 角色集合 => ApiMatcher
+_api_matcher_cache = VersionedCache(PERMISSION_VERSION, maxsize=512)
+# 用户id => 角色id集合
+_user_role_cache = VersionedCache(PERMISSION_VERSION, maxsize=10000)
+# "api_white_list" => {enable_datasource: ApiMatcher}
+_api_white_list_cache = VersionedCache(API_WHITE_LIST_VERSION, maxsize=1)
+
+
+def build_api_white_list():
+    """
+    一次查询接口白名单, 分别生成全部、激活数据权限、不激活数据权限的匹配器
+    :return: {None: 全部, True: 激活数据权限, False: 不激活数据权限}
+    """
+    api_lists = {None: [], True: [], False: []}
+    for url, method, enable_datasource in ApiWhiteList.objects.values_list('url', 'method', 'enable_datasource'):
+        api_lists[None].append((url, method))
+        api_lists[bool(enable_datasource)].append((url, method))
+    return {key: ApiMatcher(api_list) for key, api_list in api_lists.items()}
+
+
+def get_api_white_list(enable_datasource=None):
+    """
+    获取接口白名单匹配器, 缓存在进程内, 接口白名单变更时失效
+    :param enable_datasource: None 全部接口白名单, True/False 按是否激活数据权限区分
+    :return: ApiMatcher
+    """
+    return _api_white_list_cache.get_or_set("api_white_list", build_api_white_list)[enable_datasource]
+
+
+def build_api_matcher(role_ids):
+    """
+    根据角色拥有的接口生成匹配器
+    :param role_ids: 角色id集合
+    :return: ApiMatcher
+    """
+    if not role_ids:
+        return ApiMatcher([])
+    return ApiMatcher(Role.objects.filter(id__in=role_ids).values_list('permission__api', 'permission__method'))
+
+
+def get_api_matcher(role_ids):
+    """
+    获取角色集合对应的匹配器, 按角色id集合缓存在进程内
+    :param role_ids: 角色id集合
+    :return: ApiMatcher
+    """
+    key = tuple(sorted(set(role_ids)))
+    return _api_matcher_cache.get_or_set(key, lambda: build_api_matcher(key))
+
+
+def get_user_role_ids(user):
+    """
+    获取用户关联的角色id, 按用户id缓存在进程内
+    :param user:
+    :return: tuple
+    """
+    # 认证用户缓存中已包含角色id
+    snapshot_role_ids = getattr(user, "snapshot_role_ids", None)
+    if snapshot_role_ids is not None:
+        return snapshot_role_ids
+    return _user_role_cache.get_or_set(
+        user.id, lambda: tuple(user.role.values_list('id', flat=True))
+    )
+
+
 class CustomPermission(BasePermission):
     """自定义权限"""
 
@@ -65,27 +181,15 @@ class CustomPermission(BasePermission):
         else:
             api = request.path  # 当前请求接口
             method = request.method  # 当前请求方法
-            methodList = ['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH']
-            method = methodList.index(method)
+            if method not in METHOD_LIST:
+                return False
+            method = METHOD_LIST.index(method)
             # ***接口白名单***
-            api_white_list = ApiWhiteList.objects.values(permission__api=F('url'), permission__method=F('method'))
-            api_white_list = [
-                str(item.get('permission__api').replace('{id}', '([a-zA-Z0-9-]+)')) + ":" + str(
-                    item.get('permission__method')) + '$' for item in api_white_list if item.get('permission__api')]
-            # ********#
+            if get_api_white_list().match(api, method):
+                return True
             if not hasattr(request.user, "role"):
                 return False
-            userApiList = request.user.role.values('permission__api', 'permission__method')  # 获取当前用户的角色拥有的所有接口
-            ApiList = [
-                str(item.get('permission__api').replace('{id}', '([a-zA-Z0-9-]+)')) + ":" + str(
-                    item.get('permission__method')) + '$' for item in userApiList if item.get('permission__api')]
-            new_api_ist = api_white_list + ApiList
-            new_api = api + ":" + str(method)
-            for item in new_api_ist:
-                matchObj = re.match(item, new_api, re.M | re.I)
-                if matchObj is None:
-                    continue
-                else:
-                    return True
-            else:
-                return False
+            # 令牌中的权限摘要有效时直接使用其中的角色
+            claims = get_auth_claims(request)
+            role_ids = claims["role_ids"] if claims else get_user_role_ids(request.user)
+            return get_api_matcher(role_ids).match(api, method)
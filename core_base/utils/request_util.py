@@ -2,33 +2,46 @@
 Request工具类
 """
 import json
+from collections import namedtuple
 
 import requests
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.models import AnonymousUser
 from django.urls.resolvers import ResolverMatch
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from django.utils.functional import SimpleLazyObject
+from django.utils import timezone
 from user_agents import parse
 
 from core_base.models import Logs
+from core_base.utils.authentication import CustomJWTAuthentication
+from core_base.utils.ip_location import lookup_ip
+from core_base.utils.local_cache import LRUCache
 
 
 def get_request_user(request):
     """
     获取请求user
-    (1)如果request里的user没有认证,那么则手动认证一次
+    (1)DRF 认证后会将认证结果(包括匿名用户)写回 HttpRequest.user, 直接复用, 不再重复认证
+    (2)如果request里的user没有认证,那么则手动认证一次, 并将结果保存到 request 上
     :param request:
     :return:
     """
-    user: AbstractBaseUser = getattr(request, 'user', None)
+    request = getattr(request, '_request', request)
+    user: AbstractBaseUser = request.__dict__.get('user')
+    # AuthenticationMiddleware 设置的是 SimpleLazyObject, DRF 认证后为实际的用户对象
+    if user is not None and not isinstance(user, SimpleLazyObject):
+        return user
+    user = getattr(request, 'user', None)
     if user and user.is_authenticated:
         return user
     try:
-        user, tokrn = JWTAuthentication().authenticate(request)
+        user, tokrn = CustomJWTAuthentication().authenticate(request)
     except Exception as e:
         pass
-    return user or AnonymousUser()
+    user = user or AnonymousUser()
+    request.user = user
+    return user
 
 
 def get_request_ip(request):
@@ -120,6 +133,40 @@ def get_request_canonical_path(request, ):
     return path
 
 
+# 解析后的 User-Agent: 浏览器、操作系统、设备、完整描述
+UserAgentInfo = namedtuple("UserAgentInfo", ["browser", "os", "device", "pretty"])
+# User-Agent 字符串 => UserAgentInfo
+_user_agent_cache = LRUCache(maxsize=getattr(settings, "USER_AGENT_CACHE_SIZE", 2048))
+
+
+def parse_user_agent(ua_string):
+    """
+    解析 User-Agent, 解析结果按 User-Agent 字符串缓存在进程内
+    :param ua_string: User-Agent 字符串
+    :return: UserAgentInfo
+    """
+    info = _user_agent_cache.get(ua_string)
+    if info is None:
+        user_agent = parse(ua_string)
+        info = UserAgentInfo(user_agent.get_browser(), user_agent.get_os(), user_agent.get_device(), str(user_agent))
+        _user_agent_cache.set(ua_string, info)
+    return info
+
+
+def get_user_agent(request):
+    """
+    获取请求的 User-Agent 解析结果, 同一请求只解析一次
+    :param request:
+    :return: UserAgentInfo
+    """
+    request = getattr(request, '_request', request)
+    info = getattr(request, 'request_user_agent', None)
+    if info is None:
+        info = parse_user_agent(request.META.get('HTTP_USER_AGENT', ''))
+        request.request_user_agent = info
+    return info
+
+
 def get_browser(request, ):
     """
     获取浏览器名
@@ -128,9 +175,7 @@ def get_browser(request, ):
     :param kwargs:
     :return:
     """
-    ua_string = request.META['HTTP_USER_AGENT']
-    user_agent = parse(ua_string)
-    return user_agent.get_browser()
+    return get_user_agent(request).browser
 
 
 def get_os(request, ):
@@ -141,9 +186,7 @@ def get_os(request, ):
     :param kwargs:
     :return:
     """
-    ua_string = request.META['HTTP_USER_AGENT']
-    user_agent = parse(ua_string)
-    return user_agent.get_os()
+    return get_user_agent(request).os
 
 
 def get_verbose_name(queryset=None, view=None, model=None):
@@ -190,8 +233,16 @@ def get_ip_analysis(ip):
     }
     if ip != 'unknown' and ip:
         if getattr(settings, 'ENABLE_LOGIN_ANALYSIS_LOG', True):
+            # 优先查询离线IP地址库
+            location = lookup_ip(ip)
+            if location:
+                return {**data, **location}
+            remote_url = getattr(settings, 'IP_ANALYSIS_REMOTE_URL', None)
+            if not remote_url:
+                return data
             try:
-                res = requests.get(url='https://ip.django-vue-admin.com/ip/analysis', params={"ip": ip}, timeout=5)
+                res = requests.get(url=remote_url, params={"ip": ip},
+                                   timeout=getattr(settings, 'IP_ANALYSIS_REMOTE_TIMEOUT', 2))
                 if res.status_code == 200:
                     res_data = res.json()
                     if res_data.get('code') == 0:
@@ -202,21 +253,54 @@ def get_ip_analysis(ip):
     return data
 
 
-def save_login_log(request):
+def get_login_log_facts(request):
     """
-    保存登录日志
+    获取登录的原始信息, 归属地/User-Agent 解析在写入日志时进行
+    :param request:
+    :return:
+    """
+    request = getattr(request, '_request', request)
+    return {
+        'username': request.user.username,
+        'creator': request.user.id,
+        'dept_belong_id': getattr(request.user, 'dept_id', ''),
+        'request_ip': get_request_ip(request=request),
+        'request_agent': request.META.get('HTTP_USER_AGENT', ''),
+        'login_datetime': timezone.now(),
+    }
+
+
+def build_login_log(facts):
+    """
+    根据登录的原始信息生成登录日志数据
+    :param facts: get_login_log_facts 返回的原始信息
     :return:
     """
-    ip = get_request_ip(request=request)
-    analysis_data = get_ip_analysis(ip)
+    user_agent = parse_user_agent(facts['request_agent'] or '')
+    analysis_data = get_ip_analysis(facts['request_ip'])
     analysis_data['logtype'] = 4
-    analysis_data['username'] = request.user.username
-    analysis_data['request_ip'] = ip
-    analysis_data['request_agent'] = str(parse(request.META['HTTP_USER_AGENT']))
-    analysis_data['request_browser'] = get_browser(request)
-    analysis_data['request_os'] = get_os(request)
-    analysis_data['creator'] = request.user.id
-    analysis_data['dept_belong_id'] = getattr(request.user, 'dept_id', '')
+    analysis_data['username'] = facts['username']
+    analysis_data['request_ip'] = facts['request_ip']
+    analysis_data['request_agent'] = user_agent.pretty
+    analysis_data['request_browser'] = user_agent.browser
+    analysis_data['request_os'] = user_agent.os
+    analysis_data['creator'] = facts['creator']
+    analysis_data['dept_belong_id'] = facts['dept_belong_id']
     analysis_data['response_code'] = "200"
     analysis_data['execute_result'] = "登录成功"
-    Logs.objects.create(**analysis_data)
+    return analysis_data
+
+
+def save_login_log(request):
+    """
+    保存登录日志
+    LOGIN_LOG_ASYNC 为 True 时请求中只记录原始信息, 由后台线程解析并批量写入
+    :return:
+    """
+    facts = get_login_log_facts(request)
+    if getattr(settings, 'LOGIN_LOG_ASYNC', False):
+        from core_base.utils.login_log import get_login_log_pipeline
+
+        get_login_log_pipeline().put(facts)
+        return
+    Logs.objects.create(**build_login_log(facts))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
+from django.db import models
 from rest_framework import serializers
 from rest_framework.fields import empty
 from rest_framework.request import Request
@@ -7,46 +9,114 @@ from rest_framework.serializers import ModelSerializer
 from django.utils.functional import cached_property
 from rest_framework.utils.serializer_helpers import BindingDict
 
-from core_base.models import Users
+from core_base.models import Users, BlindIndexField
+from core_base.utils.local_cache import LRUCache
 from django_restql.mixins import DynamicFieldsMixin
 
 
+# 用户id => 姓名, 用户保存/删除时由信号清除对应缓存
+_user_name_cache = LRUCache(
+    maxsize=getattr(settings, "USER_NAME_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "USER_NAME_CACHE_TTL", 300),
+)
+_MISSING = object()
+
+
+def get_user_names(user_ids):
+    """
+    批量获取用户姓名, 未命中缓存的用户通过一次 id__in 查询获取
+    :param user_ids: 用户id列表
+    :return: {str(用户id): 姓名}
+    """
+    names = {}
+    missing_ids = []
+    for user_id in {str(user_id) for user_id in user_ids if user_id not in (None, "")}:
+        name = _user_name_cache.get(user_id, _MISSING)
+        if name is _MISSING:
+            missing_ids.append(user_id)
+        else:
+            names[user_id] = name
+    query_ids = [user_id for user_id in missing_ids if user_id.isdigit()]
+    found = {}
+    if query_ids:
+        found = {str(pk): name for pk, name in Users.objects.filter(id__in=query_ids).values_list("id", "name")}
+    for user_id in missing_ids:
+        names[user_id] = found.get(user_id) or None
+        _user_name_cache.set(user_id, names[user_id])
+    return names
+
+
+def invalidate_user_name(user_id):
+    """
+    清除用户姓名缓存
+    :param user_id: 用户id
+    :return:
+    """
+    _user_name_cache.delete(str(user_id))
+
+
+class CustomListSerializer(serializers.ListSerializer):
+    """
+    批量序列化时一次性获取本页所有创建人/修改人的姓名
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        iterable = list(iterable)
+        child = self.child
+        user_ids = []
+        fields = child.fields
+        for instance in iterable:
+            if "creator_name" in fields:
+                user_ids.append(getattr(instance, child.creator_field_id, None))
+            if "modifier_name" in fields:
+                user_ids.append(getattr(instance, child.modifier_field_id, None))
+        child._user_names = get_user_names(user_ids)
+        try:
+            return super().to_representation(iterable)
+        finally:
+            child._user_names = None
+
+
 class CustomModelSerializer(DynamicFieldsMixin, ModelSerializer):
     """
     增强DRF的ModelSerializer,可自动更新模型的审计字段记录
     (1)self.request能获取到rest_framework.request.Request对象
+    (2)many=True 时创建人/修改人姓名按页批量获取
     """
     # 创建人的审计字段名称, 默认creator, 继承使用时可自定义覆盖
     creator_field_id = "creator"
     creator_name = serializers.SerializerMethodField(read_only=True)
+    # CustomListSerializer 预先获取的本页用户姓名
+    _user_names = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Meta 未自定义 list_serializer_class 时使用 CustomListSerializer
+        meta = cls.__dict__.get("Meta")
+        if meta is not None and not hasattr(meta, "list_serializer_class"):
+            meta.list_serializer_class = CustomListSerializer
+
+    def get_user_name(self, user_id):
+        if user_id in (None, ""):
+            return None
+        if self._user_names and str(user_id) in self._user_names:
+            return self._user_names[str(user_id)]
+        return get_user_names([user_id]).get(str(user_id))
 
     def get_creator_name(self, instance):
-        if not hasattr(instance, "creator"):
+        if not hasattr(instance, self.creator_field_id):
             return None
-        queryset = (
-            Users.objects.filter(id=instance.creator)
-            .values_list("name", flat=True)
-            .first()
-        )
-        if queryset:
-            return queryset
-        return None
+        return self.get_user_name(getattr(instance, self.creator_field_id))
 
     # 修改人的审计字段名称, 默认modifier, 继承使用时可自定义覆盖
     modifier_field_id = "modifier"
     modifier_name = serializers.SerializerMethodField(read_only=True)
 
     def get_modifier_name(self, instance):
-        if not hasattr(instance, "modifier"):
+        if not hasattr(instance, self.modifier_field_id):
             return None
-        queryset = (
-            Users.objects.filter(id=instance.modifier)
-            .values_list("name", flat=True)
-            .first()
-        )
-        if queryset:
-            return queryset
-        return None
+        return self.get_user_name(getattr(instance, self.modifier_field_id))
 
 
     '''
@@ -72,21 +142,46 @@ class CustomModelSerializer(DynamicFieldsMixin, ModelSerializer):
     def save(self, **kwargs):
         return super().save(**kwargs)
 
+    def get_audit_data(self, validated_data, created=True):
+        """
+        当前请求用户对应的审计字段值
+        :param validated_data: 校验后的数据, 已指定数据归属部门时不覆盖
+        :param created: 是否新增, 新增时包含创建人及数据归属部门
+        :return: {字段名: 值}
+        """
+        audit_data = {}
+        if not self.request or str(self.request.user) == "AnonymousUser":
+            return audit_data
+        if self.modifier_field_id in self.fields.fields:
+            audit_data[self.modifier_field_id] = self.get_request_user_id()
+        if not created:
+            return audit_data
+        if self.creator_field_id in self.fields.fields:
+            audit_data[self.creator_field_id] = self.get_request_user_id()
+        if (
+            self.dept_belong_id_field_name in self.fields.fields
+            and validated_data.get(self.dept_belong_id_field_name, None) is None
+        ):
+            audit_data[self.dept_belong_id_field_name] = getattr(
+                self.request.user, "dept_id", None
+            )
+        return audit_data
+
+    def get_field_names(self, declared_fields, info):
+        """
+        fields = "__all__" 时不输出盲索引列, 显式声明的字段除外
+        :param declared_fields:
+        :param info:
+        :return:
+        """
+        field_names = super().get_field_names(declared_fields, info)
+        blind_index_names = {
+            field.name for field in self.Meta.model._meta.concrete_fields if isinstance(field, BlindIndexField)
+        }
+        return [name for name in field_names if name not in blind_index_names or name in declared_fields]
+
     def create(self, validated_data):
-        if self.request:
-            if str(self.request.user) != "AnonymousUser":
-                if self.modifier_field_id in self.fields.fields:
-                    validated_data[self.modifier_field_id] = self.get_request_user_id()
-                if self.creator_field_id in self.fields.fields:
-                    validated_data[self.creator_field_id] = self.get_request_user_id()
-
-                if (
-                    self.dept_belong_id_field_name in self.fields.fields
-                    and validated_data.get(self.dept_belong_id_field_name, None) is None
-                ):
-                    validated_data[self.dept_belong_id_field_name] = getattr(
-                        self.request.user, "dept_id", None
-                    )
+        validated_data.update(self.get_audit_data(validated_data))
         return super().create(validated_data)
 
     def update(self, instance, validated_data):